@@ -1 +1,2 @@
 from .achim import cli
+from .api import Achim
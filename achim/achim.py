@@ -1,14 +1,49 @@
+import datetime
+import hashlib
+import ipaddress
+import os
+import secrets
 import sys
-from functools import reduce
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 from dotenv import dotenv_values
 from achim.exoscale import Exoscale
+from achim import models
 from jinja2 import Environment, PackageLoader, Template, select_autoescape
 import requests
 import yaml
 
-from achim.utils import is_valid_ipv4, parse_label_value_arg
+from achim.scheduler import place_scenario
+from achim.sshkeys import keys_path, register_user_keys
+from achim.names import (
+    NameCache,
+    choice_completer,
+    complete_selector,
+    completer,
+    label_completer,
+)
+from achim.output import Output, formats as output_formats
+from achim.fleet import (
+    fleet_columns,
+    fleet_rows,
+    formats as fleet_formats,
+    resolve_format as resolve_fleet_format,
+    write_fleet,
+)
+from achim.ipam import AddressRange
+from achim.loader import check_host_names, load_group, load_scenario, load_yaml
+from achim.utils import (
+    change_labels,
+    is_port_open,
+    is_valid_ipv4,
+    parse_label_value_arg,
+    parse_list_arg,
+    run_concurrently,
+    to_host_name,
+)
 
 sizes = ["micro", "tiny", "small", "medium", "large", "extra-large"]
 instance_type_filter = {
@@ -17,11 +52,32 @@ instance_type_filter = {
 }
 default_image = "Linux Debian 13 (Trixie) 64-bit"
 default_user_name = "user"
+max_workers = 16
+pool_label = "pool"
+pool_cloud_config = {
+    "package_update": True,
+    "package_upgrade": True,
+    "runcmd": [
+        [
+            "systemd-run",
+            "--no-block",
+            "sh",
+            "-c",
+            "cloud-init status --wait; cloud-init clean --logs; poweroff",
+        ]
+    ],
+}
 
 
 @click.group(help="Manage Exoscale Compute Instances")
+@click.option(
+    "--output",
+    type=click.Choice(output_formats),
+    default="table",
+    help="output format of the results",
+)
 @click.pass_context
-def cli(ctx):
+def cli(ctx, output):
     config = dotenv_values(".env")
     keys = [
         "EXOSCALE_API_KEY",
@@ -32,7 +88,11 @@ def cli(ctx):
         fatal("missing settings in .env file (see sample.env)")
 
     ctx.ensure_object(dict)
-    ctx.obj["exo"] = Exoscale(config)
+    names = NameCache()
+    ctx.call_on_close(names.save)
+    ctx.obj["config"] = config
+    ctx.obj["exo"] = Exoscale(config, names=names)
+    ctx.obj["output"] = Output(output)
 
 
 @cli.command(name="list-images", help="List Images")
@@ -40,18 +100,20 @@ def cli(ctx):
 @click.pass_context
 def list_images(ctx, contains):
     for name in get_image_names(ctx, contains):
-        print(name)
+        emit(ctx, {"name": name})
 
 
 @cli.command(name="list-instances", help="List Instances by Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
 @click.pass_context
 def list_instances(ctx, by):
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
     for instance in exo.get_instances_by(selectors):
         info = extract_instance_info(instance, ["id", "name", "state", "labels"])
-        print(info)
+        emit(ctx, info)
 
 
 @cli.command(name="create-instance", help="Create a Compute Instance")
@@ -61,8 +123,18 @@ def list_instances(ctx, by):
 @click.option("--group", help="group (label)", default="default")
 @click.option("--owner", help="owner (label)", default="default")
 @click.option("--autostart", help="automatically start VM", is_flag=True, default=False)
-@click.option("--image", help="image name", default=default_image)
-@click.option("--size", help="instance size", default="micro")
+@click.option(
+    "--image",
+    help="image name",
+    default=default_image,
+    shell_complete=completer("images"),
+)
+@click.option(
+    "--size",
+    help="instance size",
+    default="micro",
+    shell_complete=choice_completer(sizes),
+)
 @click.option(
     "--cloud-init", type=click.File("r", encoding="utf-8"), help="cloud init YAML file"
 )
@@ -86,7 +158,7 @@ def create_instance(
         cloud_init_data = yaml.load(cloud_init, yaml.SafeLoader)
     exo = ctx.obj["exo"]
     existing = exo.get_instances()
-    if any([instance["name"] == name for instance in existing]):
+    if any([instance.name == name for instance in existing]):
         fatal(f"name '{name}' is already in use")
     instance = do_create_instance(
         exo,
@@ -100,31 +172,37 @@ def create_instance(
         size,
         cloud_init_data=cloud_init_data,
     )
-    print(instance)
+    emit(ctx, instance)
 
 
 @cli.command(name="start", help="Start Compute Instances by Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
 @click.pass_context
 def start(ctx, by):
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
     for instance in exo.get_instances_by(selectors):
-        print(exo.start_instance(instance["id"]))
+        emit(ctx, exo.start_instance(instance.id))
 
 
 @cli.command(name="stop", help="Stop Compute Instances by Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
 @click.pass_context
 def stop(ctx, by):
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
     for instance in exo.get_instances_by(selectors):
-        print(exo.stop_instance(instance["id"]))
+        emit(ctx, exo.stop_instance(instance.id))
 
 
 @cli.command(name="destroy", help="Destroy Compute Instances by Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
 @click.option("--sure", is_flag=True, prompt=True, default=False, help="Are you sure?")
 @click.pass_context
 def destroy(ctx, by, sure):
@@ -133,23 +211,27 @@ def destroy(ctx, by, sure):
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
     for instance in exo.get_instances_by(selectors):
-        print(exo.destroy_instance(instance["id"]))
+        emit(ctx, exo.destroy_instance(instance.id))
 
 
 @cli.command(name="protect", help="Enable Instance Protection by Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
 @click.pass_context
 def protect(ctx, by):
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
     for instance in exo.get_instances_by(selectors):
-        print(exo.protect_instance(instance["id"]))
+        emit(ctx, exo.protect_instance(instance.id))
 
 
 @cli.command(
     name="deprotect", help="Revoke Instance Protection by Label/Value Selectors"
 )
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
 @click.option("--sure", is_flag=True, prompt=True, default=False, help="Are you sure?")
 @click.pass_context
 def deprotect(ctx, by, sure):
@@ -158,7 +240,7 @@ def deprotect(ctx, by, sure):
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
     for instance in exo.get_instances_by(selectors):
-        print(exo.deprotect_instance(instance["id"]))
+        emit(ctx, exo.deprotect_instance(instance.id))
 
 
 @cli.command(name="create-group", help="Create Compute Instances for a Group")
@@ -168,51 +250,103 @@ def deprotect(ctx, by, sure):
 @click.option("--context", help="context (label)", default="default")
 @click.option("--keyname", required=True, help="name of registered SSH key")
 @click.option("--autostart", help="automatically start VM", is_flag=True, default=False)
-@click.option("--image", help="image name", default=default_image)
-@click.option("--size", help="instance size", default="micro")
+@click.option(
+    "--image",
+    help="image name",
+    default=default_image,
+    shell_complete=completer("images"),
+)
+@click.option(
+    "--size",
+    help="instance size",
+    default="micro",
+    shell_complete=choice_completer(sizes),
+)
 @click.option(
     "--ignore-existing",
     help="create group even if vms from it already exists",
     is_flag=True,
     default=False,
 )
+@click.option(
+    "--use-pool", help="claim instances from the warm pool", is_flag=True, default=False
+)
+@click.option(
+    "--golden-image",
+    help="provision from a template pre-built with the group's cloud-config",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--wait-ready",
+    help="wait until the instances accept SSH/RDP connections",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--user-keys",
+    help="register each user's ssh_key and create their instances with it",
+    is_flag=True,
+    default=False,
+)
 @click.pass_context
-def create_group(ctx, file, keyname, context, autostart, image, size, ignore_existing):
+def create_group(
+    ctx,
+    file,
+    keyname,
+    context,
+    autostart,
+    image,
+    size,
+    ignore_existing,
+    use_pool,
+    golden_image,
+    wait_ready,
+    user_keys,
+):
     must_be_valid_image(ctx, image)
     must_be_valid_size(size)
+    if wait_ready and not autostart:
+        fatal("--wait-ready requires --autostart")
+    must_have_one_shape(ctx, wait_ready)
     exo = ctx.obj["exo"]
-    existing = exo.get_instances()
-    group = yaml.load(file.read(), Loader=yaml.SafeLoader)
-    group_name = sanitize_name(group["name"])
-    users = group["users"]
-    host_names = {to_host_name(u["name"]) for u in users}
-    existing_names = {e["name"] for e in existing}
-    already_used = host_names.intersection(existing_names)
-    if already_used and not ignore_existing:
-        fatal(f"names '{already_used}' are already in use")
-    instances = []
-    for user in users:
-        host_name = to_host_name(user["name"])
-        owner_name = user["name"]
-        if host_name in already_used and ignore_existing:
-            continue
-        cloud_init_data = {}
-        if "cloud-config" in group:
-            cloud_init_data = prepare_cloud_init_data(group["cloud-config"], user)
-        instance = do_create_instance(
-            exo,
-            host_name,
-            keyname,
-            context,
-            group_name,
-            owner_name,
-            autostart,
-            image=image,
-            size=size,
-            cloud_init_data=cloud_init_data,
-        )
-        instances.append(instance)
-    print(instances)
+    existing_names = {e.name for e in exo.get_instances()}
+    try:
+        group = load_group(file)
+        users = plan_group(group, existing_names, ignore_existing)
+        user_keys = register_keys(ctx.obj["config"], exo, users) if user_keys else {}
+    except ValueError as e:
+        fatal(str(e))
+    if golden_image:
+        if "cloud-config" not in group:
+            fatal("a golden image requires a cloud-config in the groups file")
+        shared, per_user = split_cloud_config(group["cloud-config"])
+        try:
+            template = build_golden_template(exo, shared, image, size, keyname)
+        except ValueError as e:
+            fatal(str(e))
+        image = template.name
+        group = {**group, "cloud-config": per_user}
+    pool = WarmPool(exo) if use_pool else None
+    for instance in provision_group(
+        exo,
+        group,
+        users,
+        keyname,
+        context,
+        autostart,
+        image,
+        size,
+        pool=pool,
+        user_keys=user_keys,
+    ):
+        emit(ctx, instance)
+    if pool:
+        pool.report()
+    if wait_ready:
+        host_names = {to_host_name(u["name"]) for u in users}
+        instances = [i for i in exo.get_instances() if i.name in host_names]
+        wait_until_ready(ctx, instances)
 
 
 @cli.command(name="create-scenario", help="Create Scenario Instances for a Group")
@@ -229,89 +363,208 @@ def create_group(ctx, file, keyname, context, autostart, image, size, ignore_exi
 @click.option(
     "--autostart", help="automatically start VMs", is_flag=True, default=False
 )
+@click.option(
+    "--use-pool", help="claim instances from the warm pool", is_flag=True, default=False
+)
+@click.option(
+    "--wait-ready",
+    help="wait until the instances accept SSH/RDP connections",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--zones", help="comma-separated zones to spread users across (default: .env)"
+)
+@click.option(
+    "--user-keys",
+    help="register each user's ssh_key and create their instances with it",
+    is_flag=True,
+    default=False,
+)
 @click.pass_context
-def create_scenario(ctx, scenario, group, context, keyname, autostart):
-    scenario_data = yaml.load(scenario.read(), Loader=yaml.SafeLoader)
-    group_data = yaml.load(group.read(), Loader=yaml.SafeLoader)
-    exo = ctx.obj["exo"]
-    image_kinds = validate_scenario(exo, scenario_data)
-    print(image_kinds)
-    instance_data = scenario_data["instances"]
-    network_data = scenario_data["networks"]
-    group_name = sanitize_name(group_data["name"])
-    user_data = group_data["users"]
-    instances_by_username = determine_instances(instance_data, user_data)
-    networks_by_username = determine_networks(
-        network_data, user_data, instances_by_username
-    )
-    # TODO: for image_kinds['image'] == linux: build cloud_init_data
-    instances = [
-        do_create_instance(
+def create_scenario(
+    ctx,
+    scenario,
+    group,
+    context,
+    keyname,
+    autostart,
+    use_pool,
+    wait_ready,
+    zones,
+    user_keys,
+):
+    if wait_ready and not autostart:
+        fatal("--wait-ready requires --autostart")
+    must_have_one_shape(ctx, wait_ready)
+    try:
+        scenario_data = load_scenario(scenario)
+        group_data = load_group(group)
+        check_host_names(scenario_data, group_data)
+    except ValueError as e:
+        fatal(str(e))
+    config = ctx.obj["config"]
+    zones = parse_list_arg(zones) if zones else [config["EXOSCALE_ZONE"]]
+    clients = {zone: Exoscale({**config, "EXOSCALE_ZONE": zone}) for zone in zones}
+    try:
+        for exo in clients.values():
+            image_kinds = validate_scenario(exo, scenario_data)
+        quotas = {z: exo.get_quotas() for z, exo in clients.items()}
+        placement = place_scenario(group_data["users"], scenario_data, quotas)
+        if user_keys:
+            exo = next(iter(clients.values()))
+            user_keys = register_keys(ctx.obj["config"], exo, group_data["users"])
+    except ValueError as e:
+        fatal(str(e))
+    eprint(image_kinds)
+    for zone, users in placement.items():
+        eprint(f"{zone}: {len(users)} user(s)")
+
+    def provision_zone(zone):
+        exo = clients[zone]
+        zone_group = {**group_data, "users": placement[zone]}
+        pool = WarmPool(exo) if use_pool else None
+        for result in provision_scenario(
             exo,
-            to_host_name(instance_data["canonical_name"]),
+            scenario_data,
+            scenario_data.get("networks", []),
+            zone_group,
             keyname,
             context,
-            group_name,
-            username,
             autostart,
-            image=instance_data["image"],
-            size=instance_data["size"],
-            additional_labels={"scenario": scenario_data["name"]},
-        )
-        for username, instances in instances_by_username.items()
-        for instance_data in instances
-    ]
-    print(instances)
-    networks = [
-        exo.create_network(
-            to_host_name(network_data["canonical_name"]),
-            start_ip=network_data["start-ip"],
-            end_ip=network_data["end-ip"],
-            netmask=network_data["netmask"],
-            labels={"scenario": scenario_data["name"], "owner": username},
-        )
-        for username, networks in networks_by_username.items()
-        for network_data in networks
-    ]
-    print(networks)
-    attachments = [
-        exo.attach_network(a["network_id"], a["instance_id"], a["ip"])
-        for a in determine_attachments(exo, networks_by_username)
-    ]
-    print(attachments)
+            pool=pool,
+            user_keys=user_keys or {},
+        ):
+            emit(ctx, result)
+        if pool:
+            pool.report()
+        if wait_ready:
+            selectors = {
+                "scenario": scenario_data["name"],
+                "group": sanitize_name(group_data["name"]),
+            }
+            wait_until_ready(ctx, exo.get_instances_by(selectors), exo=exo)
+
+    for _zone, _done in run_concurrently(provision_zone, placement, len(placement)):
+        pass
+
+
+@cli.command(
+    name="build-golden-image",
+    help="Build a Private Template from the Cloud-Config of a Group",
+)
+@click.option(
+    "--file", type=click.File("r", encoding="utf-8"), help="groups file to be used"
+)
+@click.option("--keyname", required=True, help="name of registered SSH key")
+@click.option(
+    "--image",
+    help="base image name",
+    default=default_image,
+    shell_complete=completer("images"),
+)
+@click.option(
+    "--size",
+    help="size of the build instance",
+    default="micro",
+    shell_complete=choice_completer(sizes),
+)
+@click.pass_context
+def build_golden_image(ctx, file, keyname, image, size):
+    must_be_valid_image(ctx, image)
+    must_be_valid_size(size)
+    try:
+        group = load_group(file)
+    except ValueError as e:
+        fatal(str(e))
+    if "cloud-config" not in group:
+        fatal("a golden image requires a cloud-config in the groups file")
+    shared, _per_user = split_cloud_config(group["cloud-config"])
+    try:
+        template = build_golden_template(ctx.obj["exo"], shared, image, size, keyname)
+    except ValueError as e:
+        fatal(str(e))
+    emit(ctx, extract_instance_info(template, ["id", "name", "family"]))
+
+
+@cli.group(name="pool", help="Manage the Warm Pool of Pre-Built Instances")
+def pool():
+    pass
+
+
+@pool.command(name="fill", help="Create and Boot Instances until the Pool is Full")
+@click.option("--keyname", required=True, help="name of registered SSH key")
+@click.option(
+    "--image",
+    help="image name",
+    default=default_image,
+    shell_complete=completer("images"),
+)
+@click.option(
+    "--size",
+    help="instance size",
+    default="micro",
+    shell_complete=choice_completer(sizes),
+)
+@click.option("--count", help="number of instances to keep", type=int, required=True)
+@click.option(
+    "--workers",
+    help="number of concurrent operations",
+    type=click.IntRange(min=1),
+    default=max_workers,
+)
+@click.pass_context
+def fill(ctx, keyname, image, size, count, workers):
+    must_be_valid_image(ctx, image)
+    must_be_valid_size(size)
+    exo = ctx.obj["exo"]
+    spec = resolve_instance_spec(exo, image, size, keyname)
+    for result in fill_pool(exo, spec, count, workers):
+        emit(ctx, result)
+
+
+@pool.command(name="list", help="List the Instances of the Pool")
+@click.pass_context
+def list_pool(ctx):
+    exo = ctx.obj["exo"]
+    for instance in find_pool_instances(exo.get_instances()):
+        emit(ctx, extract_instance_info(instance, ["id", "name", "state", "labels"]))
 
 
 @cli.command(
     name="destroy-scenario",
     help="Destroy Scenario Instances and Networks by Scenario Name",
 )
-@click.option("--name", help="scenario name (see scenario file)")
+@click.option(
+    "--name",
+    help="scenario name (see scenario file)",
+    shell_complete=completer("scenarios"),
+)
+@click.option("--domain", help="also remove DNS records of the freed IPs")
+@click.option(
+    "--workers",
+    help="number of concurrent operations",
+    type=click.IntRange(min=1),
+    default=max_workers,
+)
 @click.option("--sure", is_flag=True, prompt=True, default=False, help="Are you sure?")
 @click.pass_context
-def destroy_scenario(ctx, name, sure):
+def destroy_scenario(ctx, name, domain, workers, sure):
     if not sure:
         return
     exo = ctx.obj["exo"]
-
-    def has_scenario(o):
-        return o["labels"].get("scenario", "") == name
-
-    instances = [
-        exo.destroy_instance(instance["id"])
-        for instance in filter(has_scenario, exo.get_instances())
-    ]
-    networks = [
-        exo.delete_network(network["id"])
-        for network in filter(has_scenario, exo.get_networks())
-    ]
-    print(instances)
-    print(networks)
+    for result in teardown_scenario(exo, name, domain, workers):
+        emit(ctx, result)
 
 
 @cli.command(
     name="export-scenario-overview", help="Generate HTML Overview Page for a Scenario"
 )
-@click.option("--name", help="scenario name (see scenario file)")
+@click.option(
+    "--name",
+    help="scenario name (see scenario file)",
+    shell_complete=completer("scenarios"),
+)
 @click.option("--hide-password", is_flag=True, default=False, help="Hide Password")
 @click.option("--file", type=click.File("w", encoding="utf-8"), help="HTML output file")
 @click.pass_context
@@ -319,29 +572,24 @@ def scenario_overview(ctx, name, hide_password, file):
     exo = ctx.obj["exo"]
     if not name:
         fatal("scenario name required")
-    instances = list(
-        filter(
-            lambda i: i.get("labels", {}).get("scenario", "") == name,
-            exo.get_instances(),
-        )
-    )
+    instances = [i for i in exo.get_instances() if i.label("scenario") == name]
     if not instances:
         fatal(f"no instances for scenario '{name}' found")
     overview_data = []
     for instance in instances:
-        labels = instance.get("labels", {})
-        id = instance["id"]
-        pw = exo.get_instance_password(id)
-        template_id = instance.get("template", {}).get("id", "")
-        template = exo.get_template(template_id) if template_id else {}
-        family = template.get("family", "")
-        default_user = template.get("default-user", "")
-        ip = instance.get("public-ip", "")
+        pw = exo.get_instance_password(instance.id)
+        template_id = instance.template_id
+        template = (
+            exo.get_template(template_id) if template_id else models.Template("", "")
+        )
+        family = template.family
+        default_user = template.default_user
+        ip = instance.public_ip
         connect = ("rdp" if family == "windows" else "ssh") + f" {default_user}@{ip}"
         data = {
-            "owner": labels.get("owner", ""),
-            "name": instance["name"],
-            "image": template.get("name", ""),
+            "owner": instance.label("owner"),
+            "name": instance.name,
+            "image": template.name,
             "ip": ip,
             "user": default_user,
             "password": pw if not hide_password else "********",
@@ -356,7 +604,7 @@ def scenario_overview(ctx, name, hide_password, file):
 
 
 @cli.command(name="probe", help="Tests an HTTP Service on the Instances of the Group")
-@click.option("--name", help="group name")
+@click.option("--name", help="group name", shell_complete=label_completer("group"))
 @click.option("--domain", help="domain name")
 @click.option("--suffix", help="URL suffix", default="")
 @click.option("--secure", is_flag=True, default=False, help="Use TLS?")
@@ -364,7 +612,7 @@ def scenario_overview(ctx, name, hide_password, file):
 def probe(ctx, name, domain, suffix, secure):
     exo = ctx.obj["exo"]
     instances = exo.get_instances()
-    instances = [i for i in instances if i["labels"].get("group", "") == name]
+    instances = [i for i in instances if i.label("group") == name]
     if domain:
         domain_id = exo.get_domain_id(domain)
         dns_records = exo.get_non_system_dns_records(domain_id)
@@ -372,12 +620,12 @@ def probe(ctx, name, domain, suffix, secure):
         secure = False  # TLS only possible via Hostname, not via IP
         dns_records = []
     for instance in instances:
-        ip = instance["public-ip"]
-        dns_entries = list(filter(lambda d: d["content"] == ip, dns_records))
-        owner = instance["labels"]["owner"]
+        ip = instance.public_ip
+        dns_entries = list(filter(lambda d: d.content == ip, dns_records))
+        owner = instance.label("owner")
         proto = "https" if secure else "http"
         if dns_entries:
-            addr = dns_entries[0]["name"] + "." + domain
+            addr = dns_entries[0].name + "." + domain
         else:
             addr = ip
         url = f"{proto}://{addr}/{suffix}"
@@ -386,7 +634,7 @@ def probe(ctx, name, domain, suffix, secure):
             status = res.status_code
         except Exception:
             status = "ERR"
-        print(f"{ip}\t{status}\t{owner:20s}\t{url}")
+        emit(ctx, {"ip": ip, "status": status, "owner": owner, "url": url})
 
 
 @cli.command(
@@ -403,8 +651,8 @@ def inventory(ctx, file):
     instances = exo.get_instances()
     sections = {}
     for instance in instances:
-        ip = instance["public-ip"]
-        labels = instance["labels"] | {"name": instance["name"]}
+        ip = instance.public_ip
+        labels = instance.labels | {"name": instance.name}
         for key in ["context", "group", "name"]:
             if key not in labels:
                 continue
@@ -433,41 +681,125 @@ def inventory(ctx, file):
     type=click.File("w", encoding="utf-8"),
     help="playbook file to be written",
 )
-def export_user_playbook(group_file, playbook):
-    group = yaml.load(group_file.read(), Loader=yaml.SafeLoader)
-    content = []
+@click.option(
+    "--group-vars",
+    type=click.Path(file_okay=False),
+    help="directory to write per-instance variables for export-inventory to "
+    "(group_vars)",
+)
+@click.option(
+    "--inventory",
+    type=click.File("w", encoding="utf-8"),
+    help="YAML inventory of the live group instances to be written",
+)
+@click.pass_context
+def export_user_playbook(ctx, group_file, playbook, group_vars, inventory):
+    if not group_vars and not inventory:
+        fatal("--group-vars or --inventory required for the per-host variables")
+    try:
+        group = load_group(group_file)
+    except ValueError as e:
+        fatal(str(e))
+    group_name = sanitize_name(group["name"])
+    variables = {}
     for user in group["users"]:
-        host_name = to_host_name(user["name"])
-        user_name = default_user_name
-        ssh_key = user["ssh_key"]
-        play = {
-            "name": f"User Setup for {user_name}",
-            "hosts": host_name,
-            "become": True,
-            "tasks": [
-                {
-                    "name": "User Created",
-                    "user": {
-                        "name": user_name,
-                        "shell": "/usr/bin/bash",
-                        "create_home": True,
-                        "home": f"/home/{user_name}",
-                        "password": "*",
-                        "append": True,
-                        "groups": ["sudo"],
-                    },
+        if not user.get("ssh_key"):
+            eprint(f"user '{user['name']}' has no ssh_key, skipped")
+            continue
+        variables[to_host_name(user["name"])] = {
+            "user_name": default_user_name,
+            "ssh_key": user["ssh_key"],
+        }
+    if group_vars:
+        os.makedirs(group_vars, exist_ok=True)
+        for host_name, host_variables in variables.items():
+            path = os.path.join(group_vars, f"{host_name}.yml")
+            with open(path, "w", encoding="utf-8") as f:
+                yaml.dump(host_variables, f)
+    if inventory:
+        instances = ctx.obj["exo"].get_instances_by({"group": group_name})
+        hosts = {
+            i.name: {"ansible_host": i.public_ip, **variables[i.name]}
+            for i in instances
+            if i.name in variables
+        }
+        for host_name in sorted(variables.keys() - hosts.keys()):
+            eprint(f"no instance for '{host_name}', skipped in inventory")
+        yaml.dump({group_name: {"hosts": hosts}}, inventory)
+    play = {
+        "name": f"User Setup for Group {group_name}",
+        "hosts": group_name,
+        "become": True,
+        "tasks": [
+            {
+                "name": "User Created",
+                "user": {
+                    "name": "{{ user_name }}",
+                    "shell": "/usr/bin/bash",
+                    "create_home": True,
+                    "home": "/home/{{ user_name }}",
+                    "password": "*",
+                    "append": True,
+                    "groups": ["sudo"],
                 },
-                {
-                    "name": "Key Authorized",
-                    "authorized_key": {
-                        "user": user_name,
-                        "key": ssh_key,
-                    },
+            },
+            {
+                "name": "Key Authorized",
+                "authorized_key": {
+                    "user": "{{ user_name }}",
+                    "key": "{{ ssh_key }}",
                 },
-            ],
-        }
-        content.append(play)
-    yaml.dump(content, playbook)
+            },
+        ],
+    }
+    yaml.dump([play], playbook)
+
+
+@cli.command(name="export-fleet", help="Export a Columnar Snapshot of all Instances")
+@click.option(
+    "--file",
+    type=click.Path(dir_okay=False, writable=True),
+    required=True,
+    help="snapshot file to be written",
+)
+@click.option(
+    "--format",
+    type=click.Choice(fleet_formats),
+    help="snapshot format (default: from the file extension, else parquet if pyarrow "
+    "is installed, else gzip csv)",
+)
+@click.option("--zones", help="comma-separated zones to export (default: .env)")
+@click.pass_context
+def export_fleet(ctx, file, format, zones):
+    try:
+        format = resolve_fleet_format(file, format)
+    except ValueError as e:
+        fatal(str(e))
+    config = ctx.obj["config"]
+    zones = parse_list_arg(zones) if zones else [config["EXOSCALE_ZONE"]]
+    clients = {zone: Exoscale({**config, "EXOSCALE_ZONE": zone}) for zone in zones}
+
+    def fetch(zone):
+        exo = clients[zone]
+        instances = exo.get_instances()
+        types = {t["id"]: t for t in exo.get_instance_types({})}
+        templates = exo.list_templates() + exo.list_private_templates()
+        networks = {n.id: n.name for n in exo.get_networks()}
+        return instances, types, {t.id: t for t in templates}, networks
+
+    inventories = dict(run_concurrently(fetch, zones, len(zones)))
+    snapshot_at = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    columns = fleet_columns([i for inv in inventories.values() for i in inv[0]])
+    rows = (
+        row
+        for zone in zones
+        for row in fleet_rows(snapshot_at, zone, *inventories[zone])
+    )
+    try:
+        count = write_fleet(file, format, columns, rows)
+    except ValueError as e:
+        fatal(str(e))
+    eprint(f"wrote {count} instance(s) to {file}")
 
 
 @cli.command(
@@ -482,13 +814,13 @@ def overview(ctx, key, value, file):
     exo = ctx.obj["exo"]
     instances = exo.get_instances()
     if key and value:
-        instances = [i for i in instances if i["labels"].get(key, "") == value]
+        instances = [i for i in instances if i.label(key) == value]
     if not instances:
         fatal(f"no instances matched label filter {key}={value}")
     output = []
-    for instance in sorted(instances, key=lambda i: i["name"]):
-        ip = instance["public-ip"]
-        host_name = instance["name"]
+    for instance in sorted(instances, key=lambda i: i.name):
+        ip = instance.public_ip
+        host_name = instance.name
         ssh_cmd = f"ssh {default_user_name}@{ip}"
         name_parts = host_name.split("-")
         first_name = name_parts[0].capitalize()
@@ -516,7 +848,7 @@ def list_instance_types(ctx, family):
     }
     instance_types = exo.get_instance_types(filter_rules)
     for instance_type in instance_types:
-        print(instance_type)
+        emit(ctx, instance_type)
 
 
 @cli.command(name="create-network", help="Create a Private Network")
@@ -528,12 +860,13 @@ def list_instance_types(ctx, family):
 @click.pass_context
 def create_network(ctx, name, description, start_ip, end_ip, netmask):
     must_be_valid_name(name)
-    must_be_valid_ipv4(start_ip)
-    must_be_valid_ipv4(end_ip)
-    must_be_valid_ipv4(netmask)
+    try:
+        AddressRange(start_ip, end_ip, netmask)
+    except ValueError as e:
+        fatal(str(e))
     exo = ctx.obj["exo"]
     result = exo.create_network(name, start_ip, end_ip, netmask, description)
-    print(result)
+    emit(ctx, result)
 
 
 @cli.command(name="list-network", help="List Private Networks")
@@ -542,12 +875,22 @@ def create_network(ctx, name, description, start_ip, end_ip, netmask):
 def list_networks(ctx, contains):
     networks = get_networks(ctx, contains)
     for network in networks:
-        print(network)
+        emit(ctx, network)
 
 
 @cli.command(name="attach-network", help="Attach a Private Network to an Instance")
-@click.option("--network", help="Name of the Network", required=True)
-@click.option("--instance", help="Name of the Instance", required=True)
+@click.option(
+    "--network",
+    help="Name of the Network",
+    required=True,
+    shell_complete=completer("networks"),
+)
+@click.option(
+    "--instance",
+    help="Name of the Instance",
+    required=True,
+    shell_complete=completer("instances"),
+)
 @click.option("--ip", help="Attach with static IP Address")
 @click.pass_context
 def attach_network(ctx, network, instance, ip):
@@ -556,27 +899,100 @@ def attach_network(ctx, network, instance, ip):
     if ip:
         must_be_valid_ipv4(ip)
     exo = ctx.obj["exo"]
-    instances = list(filter(lambda i: i["name"] == instance, exo.get_instances()))
-    networks = list(filter(lambda n: n["name"] == network, exo.get_networks()))
+    instances = [i for i in exo.get_instances() if i.name == instance]
+    networks = [n for n in exo.get_networks() if n.name == network]
     if len(networks) != 1:
         fatal(f"network '{network}' not found or not unique")
     if len(instances) != 1:
         fatal(f"instance '{instance}' not found or not unique")
-    network_id = networks[0]["id"]
-    instance_id = instances[0]["id"]
-    print(exo.attach_network(network_id, instance_id, ip))
+    network_id = networks[0].id
+    instance_id = instances[0].id
+    emit(ctx, exo.attach_network(network_id, instance_id, ip))
+
+
+@cli.command(
+    name="attach-networks",
+    help="Attach Private Networks to Instances from a Mapping File",
+)
+@click.option(
+    "--file",
+    type=click.File("r", encoding="utf-8"),
+    required=True,
+    help="YAML mapping: instance name -> network name -> IP (or empty)",
+)
+@click.option(
+    "--workers",
+    help="number of concurrent operations",
+    type=click.IntRange(min=1),
+    default=max_workers,
+)
+@click.pass_context
+def attach_networks(ctx, file, workers):
+    exo = ctx.obj["exo"]
+    try:
+        mapping = load_yaml(file.read())
+        static = set()
+        if isinstance(mapping, dict):
+            static = {
+                name
+                for ips in mapping.values()
+                if isinstance(ips, dict)
+                for name, ip in ips.items()
+                if ip
+            }
+        networks = [
+            exo.get_network(n.id) if n.name in static else n for n in exo.get_networks()
+        ]
+        attachments = plan_attachments(mapping, exo.get_instances(), networks)
+    except (ValueError, yaml.YAMLError) as e:
+        fatal(str(e))
+
+    def attach(instance_attachments):
+        return [
+            exo.wait_for_operation(
+                exo.attach_network(a["network_id"], a["instance_id"], a["ip"])
+            )
+            for a in instance_attachments
+        ]
+
+    attachments_by_instance = {}
+    for a in attachments:
+        attachments_by_instance.setdefault(a["instance_id"], []).append(a)
+    failed = 0
+    for instance_attachments, results in run_concurrently(
+        attach, attachments_by_instance.values(), workers
+    ):
+        for a, result in zip(instance_attachments, results):
+            state = result.get("state", "")
+            failed += state != "success"
+            emit(
+                ctx,
+                {
+                    "instance": a["instance"],
+                    "network": a["network"],
+                    "ip": a["ip"],
+                    "state": state,
+                },
+            )
+    if failed:
+        fatal(f"{failed} of {len(attachments)} attachment(s) failed")
 
 
 @cli.command(name="destroy-network", help="Destroy a Private Network")
-@click.option("--name", help="Name of the Network", required=True)
+@click.option(
+    "--name",
+    help="Name of the Network",
+    required=True,
+    shell_complete=completer("networks"),
+)
 @click.pass_context
 def destroy_network(ctx, name):
     must_be_valid_name(name)
     exo = ctx.obj["exo"]
-    networks = list(filter(lambda n: n["name"] == name, exo.get_networks()))
+    networks = [n for n in exo.get_networks() if n.name == name]
     if len(networks) != 1:
         fatal(f"network '{name}' not found or not unique")
-    print(exo.delete_network(networks[0]["id"]))
+    emit(ctx, exo.delete_network(networks[0].id))
 
 
 @cli.command(name="cleanup-networks", help="Destroy Orphaned Private Networks")
@@ -588,11 +1004,70 @@ def destroy_orphaned_networks(ctx, sure):
     exo = ctx.obj["exo"]
     networks = exo.get_networks()
     instances = exo.get_instances()
-    all_network_ids = set([n["id"] for n in networks])
-    used_network_ids = set([n["id"] for i in instances for n in i["private-networks"]])
+    all_network_ids = {n.id for n in networks}
+    used_network_ids = {id for i in instances for id in i.private_network_ids}
     orphaned_network_ids = all_network_ids - used_network_ids
     for network_id in orphaned_network_ids:
-        print(exo.delete_network(network_id))
+        emit(ctx, exo.delete_network(network_id))
+
+
+@cli.command(name="gc", help="Destroy Orphaned Instances, Networks and DNS Records")
+@click.option("--domain", help="also collect stale DNS records of this domain")
+@click.option(
+    "--stale-scenarios",
+    help="comma-separated scenarios to destroy (instances and networks)",
+    default="",
+)
+@click.option("--dry-run", is_flag=True, default=False, help="only print the plan")
+@click.option(
+    "--workers",
+    help="number of concurrent operations",
+    type=click.IntRange(min=1),
+    default=max_workers,
+)
+@click.option("--sure", is_flag=True, default=False, help="do not ask for confirmation")
+@click.pass_context
+def gc(ctx, domain, stale_scenarios, dry_run, workers, sure):
+    exo = ctx.obj["exo"]
+    instances = exo.get_instances()
+    networks = exo.get_networks()
+    records = []
+    if domain:
+        domain_id = exo.get_domain_id(domain)
+        records = exo.get_non_system_dns_records(domain_id)
+    stale_scenarios = set(parse_list_arg(stale_scenarios))
+    orphans, attached = find_orphans(instances, networks, records, stale_scenarios)
+    for kind, objects in orphans.items():
+        for o in objects:
+            name = o.content if kind == "record" else o.name
+            emit(ctx, {"kind": kind, "id": o.id, "name": name})
+    total = sum(map(len, orphans.values()))
+    eprint(", ".join(f"{len(objs)} {kind}(s)" for kind, objs in orphans.items()))
+    if dry_run or not total:
+        return
+    if not sure and not click.confirm("Destroy these resources?"):
+        return
+
+    def destroy_instance(instance):
+        return exo.wait_for_operation(exo.destroy_instance(instance.id))
+
+    destroyed_ids = {i.id for i in orphans["instance"]}
+
+    def delete_network(network):
+        for instance_id in attached.get(network.id, []):
+            if instance_id not in destroyed_ids:
+                exo.wait_for_operation(exo.detach_network(network.id, instance_id))
+        return exo.wait_for_operation(exo.delete_network(network.id))
+
+    delete_record = lambda r: exo.delete_dns_record(domain_id, r.id)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(destroy_instance, i) for i in orphans["instance"]]
+        for future in as_completed(futures):
+            emit(ctx, future.result())
+        futures = [pool.submit(delete_network, n) for n in orphans["network"]]
+        futures += [pool.submit(delete_record, r) for r in orphans["record"]]
+        for future in as_completed(futures):
+            emit(ctx, future.result())
 
 
 @cli.command(name="flush-networks", help="Destroy all Private Networks")
@@ -603,10 +1078,38 @@ def destroy_all_networks(ctx, sure):
         return
     exo = ctx.obj["exo"]
     for network in exo.get_networks():
-        print(exo.delete_network(network["id"]))
+        emit(ctx, exo.delete_network(network.id))
+
+
+@cli.command(name="label", help="Change Instance Labels by Label/Value Selectors")
+@click.option(
+    "--by",
+    help="label=value pairs selector (all instances if omitted)",
+    shell_complete=complete_selector,
+)
+@click.option("--add", help="label=value pairs to be set", default="")
+@click.option("--remove", help="comma-separated label keys to be removed", default="")
+@click.option("--rename", help="old=new pairs of label keys to be renamed", default="")
+@click.option(
+    "--workers",
+    help="number of concurrent updates",
+    type=click.IntRange(min=1),
+    default=max_workers,
+)
+@click.pass_context
+def label(ctx, by, add, remove, rename, workers):
+    exo = ctx.obj["exo"]
+    add = parse_label_value_arg(add) if add else {}
+    remove = parse_list_arg(remove)
+    rename = parse_label_value_arg(rename) if rename else {}
+    if not add and not remove and not rename:
+        fatal("one of --add, --remove or --rename required")
+    selectors = parse_label_value_arg(by) if by else {}
+    instances = exo.get_instances_by(selectors)
+    for result in relabel_instances(exo, instances, add, remove, rename, workers):
+        emit(ctx, result)
 
 
-# TODO: consider label/value selection (all instances if not restricted)
 @cli.command(name="label-all-instances", help="Add Label to all Instances")
 @click.option("--key", help="Key of the Label", required=True)
 @click.option("--value", help="Value of the Label", required=True)
@@ -616,11 +1119,8 @@ def add_label(ctx, key, value):
     if not key or not value:
         fatal("key and value required")
     instances = exo.get_instances()
-    for instance in instances:
-        existing = instance.get("labels", {})
-        print(
-            exo.update_instance_labels(instance["id"], labels={**existing, key: value})
-        )
+    for result in relabel_instances(exo, instances, add={key: value}):
+        emit(ctx, result)
 
 
 @cli.command(name="flush-dns", help="Flush all non-system DNS Records of a Domain")
@@ -633,9 +1133,9 @@ def flush_dns(ctx, domain, sure):
     exo = ctx.obj["exo"]
     domain_id = exo.get_domain_id(domain)
     records = exo.get_non_system_dns_records(domain_id)
-    record_ids = map(lambda r: r.get("id", ""), records)
+    record_ids = map(lambda r: r.id, records)
     for record_id in record_ids:
-        print(exo.delete_dns_record(domain_id, record_id))
+        emit(ctx, exo.delete_dns_record(domain_id, record_id))
 
 
 @cli.command(name="sync-dns", help="Sync VM hostnames with DNS records for a Domain")
@@ -643,61 +1143,135 @@ def flush_dns(ctx, domain, sure):
 @click.pass_context
 def sync_dns(ctx, domain):
     exo = ctx.obj["exo"]
-    ips_hostnames = [(i["public-ip"], i["name"]) for i in exo.get_instances()]
+    ips_hostnames = [(i.public_ip, i.name) for i in exo.get_instances()]
     domain_id = exo.get_domain_id(domain)
     records = exo.get_non_system_dns_records(domain_id)
-    existing = set([(r["content"], r["name"]) for r in records])
+    existing = set([(r.content, r.name) for r in records])
     required = set(ips_hostnames)
     to_be_deleted = existing - required
     to_be_created = required - existing
     for ip, _name in to_be_deleted:
-        matches = filter(lambda r: r["content"] == ip, records)
-        matching_ids = map(lambda r: r["id"], matches)
+        matches = filter(lambda r: r.content == ip, records)
+        matching_ids = map(lambda r: r.id, matches)
         for id in matching_ids:
-            print("deleted", exo.delete_dns_record(domain_id, id))
+            result = exo.delete_dns_record(domain_id, id)
+            emit(ctx, {"action": "deleted", **result})
     for ip, name in to_be_created:
-        print("created", exo.create_dns_record(domain_id, name, ip, ttl=300))
+        result = exo.create_dns_record(domain_id, name, ip, ttl=300)
+        emit(ctx, {"action": "created", **result})
 
 
 @cli.command(name="check-state", help="Check Instance State for Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    default=False,
+    help="keep polling and only print state transitions",
+)
+@click.option(
+    "--until",
+    help="comma-separated target states to stop watching at",
+    default="running",
+)
+@click.option("--timeout", help="seconds to watch at most", default=900)
 @click.pass_context
-def check_state(ctx, by):
+def check_state(ctx, by, watch, until, timeout):
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
-    for instance in exo.get_instances_by(selectors):
-        print(extract_instance_info(instance, ["name", "state"]))
+    if not watch:
+        for instance in exo.get_instances_by(selectors):
+            emit(ctx, extract_instance_info(instance, ["name", "state"]))
+        return
+    targets = set(parse_list_arg(until))
+    states = {}
+    for transition in watch_states(exo, selectors, targets, timeout=timeout):
+        emit(ctx, transition)
+        states[transition["name"]] = transition["to"]
+    pending = [n for n, st in states.items() if st not in targets | {"gone"}]
+    if pending:
+        fatal(f"not in {until} after {timeout}s: {', '.join(sorted(pending))}")
+
+
+@cli.command(name="wait-ready", help="Wait until Instances accept SSH/RDP Connections")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
+@click.option(
+    "--password",
+    is_flag=True,
+    default=False,
+    help="also wait until the instance password is available",
+)
+@click.option("--timeout", help="seconds to wait per instance", default=900)
+@click.pass_context
+def wait_ready(ctx, by, password, timeout):
+    exo = ctx.obj["exo"]
+    selectors = parse_label_value_arg(by)
+    wait_until_ready(ctx, exo.get_instances_by(selectors), password, timeout)
 
 
 @cli.command(name="resize-disk", help="Resize Instances by Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
 @click.option("--size", help="new disk size in GB", type=int)
+@click.option(
+    "--wave-size",
+    help="instances to update at a time",
+    type=click.IntRange(min=1),
+    default=5,
+)
+@click.option(
+    "--wait-ready",
+    help="wait until restarted instances accept connections before the next wave",
+    is_flag=True,
+    default=False,
+)
+@click.option("--timeout", help="seconds to wait for readiness", default=900)
 @click.pass_context
-def resize_disk(ctx, by, size):
+def resize_disk(ctx, by, size, wave_size, wait_ready, timeout):
+    must_have_one_shape(ctx, wait_ready)
     exo = ctx.obj["exo"]
     selectors = parse_label_value_arg(by)
-    for instance in exo.get_instances_by(selectors):
-        print(exo.resize_disk(instance["id"], size))
+    instances = exo.get_instances_by(selectors)
+    change = lambda instance: exo.resize_disk(instance.id, size)
+    roll_out(ctx, instances, change, wave_size, wait_ready, timeout)
 
 
 @cli.command(name="scale-instance", help="Scale Instances by Label/Value Selectors")
-@click.option("--by", help="label=value pairs selector")
-@click.option("--size", help="new instance size")
+@click.option(
+    "--by", help="label=value pairs selector", shell_complete=complete_selector
+)
+@click.option(
+    "--size", help="new instance size", shell_complete=choice_completer(sizes)
+)
+@click.option(
+    "--wave-size",
+    help="instances to update at a time",
+    type=click.IntRange(min=1),
+    default=5,
+)
+@click.option(
+    "--wait-ready",
+    help="wait until restarted instances accept connections before the next wave",
+    is_flag=True,
+    default=False,
+)
+@click.option("--timeout", help="seconds to wait for readiness", default=900)
 @click.pass_context
-def scale_instance(ctx, by, size):
+def scale_instance(ctx, by, size, wave_size, wait_ready, timeout):
+    must_have_one_shape(ctx, wait_ready)
     exo = ctx.obj["exo"]
-    filter_rules = {
-        "authorized": True,
-        "family": "standard",
-    }
-    types = list(
-        filter(lambda it: it["size"] == size, exo.get_instance_types(filter_rules))
-    )
-    if not types:
+    types = instance_types_by_size(exo)
+    if size not in types:
         fatal(f"no intance types for size {size}")
     selectors = parse_label_value_arg(by)
-    for instance in exo.get_instances_by(selectors):
-        print(exo.scale_instance(instance["id"], types[0]))
+    instances = exo.get_instances_by(selectors)
+    change = lambda instance: exo.scale_instance(instance.id, types[size])
+    roll_out(ctx, instances, change, wave_size, wait_ready, timeout)
 
 
 def do_create_instance(
@@ -712,23 +1286,16 @@ def do_create_instance(
     size="",
     additional_labels={},
     cloud_init_data={},
+    spec=None,
 ):
-    template = exo.get_template_by_name(image)
-    instance_types = exo.get_instance_types(instance_type_filter)
-    smallest = list(filter(lambda it: it["size"] == size, instance_types))[0]
-    ssh_key = exo.get_ssh_key(keyname)
-    labels = {
-        "name": name,
-        "context": context,
-        "group": group,
-        "owner": owner,
-        **additional_labels,
-    }
-    labels = {k: v for (k, v) in labels.items() if v}
+    template, instance_type, ssh_key = spec or resolve_instance_spec(
+        exo, image, size, keyname
+    )
+    labels = instance_labels(name, context, group, owner, additional_labels)
     return exo.create_instance(
         name,
         template,
-        smallest,
+        instance_type,
         ssh_key,
         labels,
         autostart,
@@ -736,10 +1303,554 @@ def do_create_instance(
     )
 
 
+def instance_labels(name, context="", group="", owner="", additional_labels={}):
+    labels = {
+        "name": name,
+        "context": context,
+        "group": group,
+        "owner": owner,
+        **additional_labels,
+    }
+    return {k: v for (k, v) in labels.items() if v}
+
+
+def resolve_instance_spec(exo, image, size, keyname):
+    template = exo.get_template_by_name(image)
+    instance_type = instance_types_by_size(exo)[size]
+    return template, instance_type, exo.get_ssh_key(keyname)
+
+
+def instance_types_by_size(exo):
+    return {it["size"]: it for it in exo.get_instance_types(instance_type_filter)}
+
+
+def plan_group(group, existing_names=set(), ignore_existing=False):
+    if not group.get("name"):
+        raise ValueError("missing group name in groups file")
+    users = group.get("users", [])
+    host_names = {to_host_name(u["name"]) for u in users}
+    already_used = host_names.intersection(existing_names)
+    if already_used and not ignore_existing:
+        raise ValueError(f"names '{already_used}' are already in use")
+    return [u for u in users if to_host_name(u["name"]) not in already_used]
+
+
+def provision_group(
+    exo,
+    group,
+    users,
+    keyname,
+    context="",
+    autostart=False,
+    image=default_image,
+    size="micro",
+    workers=max_workers,
+    executor=None,
+    pool=None,
+    user_keys={},
+):
+    group_name = sanitize_name(group["name"])
+    group_spec = resolve_instance_spec(exo, image, size, keyname)
+
+    def create(user):
+        cloud_init_data = {}
+        if "cloud-config" in group:
+            cloud_init_data = prepare_cloud_init_data(group["cloud-config"], user)
+        host_name = to_host_name(user["name"])
+        spec = with_user_key(group_spec, user_keys, user["name"])
+        pooled = pool.claim(spec) if pool else None
+        if pooled:
+            labels = instance_labels(host_name, context, group_name, user["name"])
+            return claim_pool_instance(
+                exo, pooled, host_name, labels, autostart, cloud_init_data
+            )
+        return do_create_instance(
+            exo,
+            host_name,
+            keyname,
+            context,
+            group_name,
+            user["name"],
+            autostart,
+            cloud_init_data=cloud_init_data,
+            spec=spec,
+        )
+
+    for _user, instance in run_concurrently(create, users, workers, executor):
+        yield instance
+
+
+def provision_scenario(
+    exo,
+    scenario_data,
+    network_data,
+    group_data,
+    keyname,
+    context="",
+    autostart=False,
+    workers=max_workers,
+    executor=None,
+    pool=None,
+    user_keys={},
+):
+    group_name = sanitize_name(group_data["name"])
+    user_data = group_data["users"]
+    labels = {"scenario": scenario_data["name"]}
+    instances_by_username = determine_instances(scenario_data["instances"], user_data)
+    networks_by_username = determine_networks(
+        network_data, user_data, instances_by_username
+    )
+    specs = {
+        (i["image"], i["size"]): resolve_instance_spec(
+            exo, i["image"], i["size"], keyname
+        )
+        for i in scenario_data["instances"]
+    }
+
+    # TODO: for image_kinds['image'] == linux: build cloud_init_data
+    def create_instance(username, instance_data):
+        host_name = to_host_name(instance_data["canonical_name"])
+        spec = specs[(instance_data["image"], instance_data["size"])]
+        spec = with_user_key(spec, user_keys, username)
+        pooled = pool.claim(spec) if pool else None
+        if pooled:
+            return claim_pool_instance(
+                exo,
+                pooled,
+                host_name,
+                instance_labels(host_name, context, group_name, username, labels),
+                autostart,
+            )
+        instance = do_create_instance(
+            exo,
+            host_name,
+            keyname,
+            context,
+            group_name,
+            username,
+            autostart,
+            additional_labels=labels,
+            spec=spec,
+        )
+        return exo.wait_for_operation(instance)
+
+    def create_network(username, network_data):
+        network = exo.create_network(
+            to_host_name(network_data["canonical_name"]),
+            start_ip=network_data.get("start-ip", ""),
+            end_ip=network_data.get("end-ip", ""),
+            netmask=network_data.get("netmask", ""),
+            labels={**labels, "owner": username},
+        )
+        return exo.wait_for_operation(network)
+
+    def attach(attachments):
+        return [
+            exo.wait_for_operation(
+                exo.attach_network(a["network_id"], a["instance_id"], a["ip"])
+            )
+            for a in attachments
+        ]
+
+    tasks = [
+        lambda u=u, i=i: create_instance(u, i)
+        for u, instances in instances_by_username.items()
+        for i in instances
+    ] + [
+        lambda u=u, n=n: create_network(u, n)
+        for u, networks in networks_by_username.items()
+        for n in networks
+    ]
+    for _task, result in run_concurrently(lambda t: t(), tasks, workers, executor):
+        yield result
+    attachments_by_instance = {}
+    for a in determine_attachments(exo, networks_by_username):
+        attachments_by_instance.setdefault(a["instance_id"], []).append(a)
+    for _attachments, results in run_concurrently(
+        attach, attachments_by_instance.values(), workers, executor
+    ):
+        yield from results
+
+
+def register_keys(config, exo, users, workers=max_workers):
+    path = keys_path(config["EXOSCALE_API_KEY"])
+    return register_user_keys(exo, users, path, workers)
+
+
+def with_user_key(spec, user_keys, user_name):
+    if user_name not in user_keys:
+        return spec
+    template, instance_type, _ssh_key = spec
+    return template, instance_type, {"name": user_keys[user_name]}
+
+
+class WarmPool:
+    def __init__(self, exo):
+        self.exo = exo
+        self.available = None
+        self.claimed = {}
+        self.lock = threading.Lock()
+
+    def claim(self, spec):
+        key = pool_key(spec)
+        with self.lock:
+            if self.available is None:
+                self.available = {}
+                for instance in find_pool_instances(self.exo.get_instances()):
+                    self.available.setdefault(pool_key(instance), []).append(instance)
+            instances = self.available.get(key, [])
+            if not instances:
+                return None
+            self.claimed[key] = (spec, self.claimed.get(key, (spec, 0))[1] + 1)
+            return instances.pop()
+
+    def report(self):
+        count = sum(n for _spec, n in self.claimed.values())
+        if count:
+            eprint(f"claimed {count} pool instance(s), refill with 'achim pool fill'")
+
+
+def pool_key(spec_or_instance):
+    if isinstance(spec_or_instance, tuple):
+        template, instance_type, ssh_key = spec_or_instance
+        return template.id, instance_type["id"], ssh_key["name"]
+    return (
+        spec_or_instance.template_id,
+        spec_or_instance.instance_type_id,
+        spec_or_instance.ssh_key,
+    )
+
+
+def find_pool_instances(instances, spec=None):
+    return [
+        i
+        for i in instances
+        if pool_label in i.labels
+        and i.state == "stopped"
+        and (spec is None or pool_key(i) == pool_key(spec))
+    ]
+
+
+def fill_pool(exo, spec, count, workers=max_workers):
+    template, instance_type, ssh_key = spec
+    size = instance_type["size"]
+    available = find_pool_instances(exo.get_instances(), spec)
+
+    def create(_n):
+        name = f"{pool_label}-{size}-{secrets.token_hex(4)}"
+        operation = exo.wait_for_operation(
+            do_create_instance(
+                exo,
+                name,
+                ssh_key["name"],
+                autostart=True,
+                additional_labels={pool_label: size},
+                cloud_init_data=pool_cloud_config,
+                spec=spec,
+            )
+        )
+        if operation.get("state", "") != "success":
+            return {"name": name, "state": operation.get("state", "")}
+        instance_id = operation["reference"]["id"]
+        instance = exo.wait_for_instance_state(instance_id, ["stopped"], timeout=3600)
+        return extract_instance_info(instance, ["id", "name", "state"])
+
+    missing = range(max(0, count - len(available)))
+    for _n, result in run_concurrently(create, missing, workers):
+        yield result
+
+
+def claim_pool_instance(exo, instance, name, labels, autostart, cloud_init_data={}):
+    result = exo.wait_for_operation(
+        exo.update_instance(
+            instance.id, name=name, labels=labels, cloud_init_data=cloud_init_data
+        )
+    )
+    if autostart:
+        result = exo.wait_for_operation(exo.start_instance(instance.id))
+    return result
+
+
+def split_cloud_config(cloud_config):
+    def is_per_user(key, value):
+        return key == "users" or "{{" in yaml.dump(value)
+
+    shared = {k: v for k, v in cloud_config.items() if not is_per_user(k, v)}
+    per_user = {k: v for k, v in cloud_config.items() if is_per_user(k, v)}
+    return shared, per_user
+
+
+def golden_template_name(cloud_config, image):
+    dump = yaml.dump({"image": image, "cloud-config": cloud_config}, sort_keys=True)
+    digest = hashlib.sha256(dump.encode("utf-8")).hexdigest()
+    return f"achim-golden-{digest[:16]}"
+
+
+def build_golden_template(exo, cloud_config, image, size, keyname):
+    name = golden_template_name(cloud_config, image)
+    cached = [t for t in exo.list_private_templates() if t.name == name]
+    if cached:
+        eprint(f"using cached golden image '{name}'")
+        return cached[0]
+    eprint(f"building golden image '{name}' from '{image}'")
+    base_template = exo.get_template_by_name(image)
+    build_data = {**cloud_config, "power_state": {"mode": "poweroff"}}
+    operation = exo.wait_for_operation(
+        do_create_instance(
+            exo,
+            f"{name}-build",
+            keyname,
+            autostart=True,
+            image=image,
+            size=size,
+            cloud_init_data=build_data,
+        )
+    )
+    must_succeed(operation, f"creating build instance '{name}-build'")
+    instance_id = operation["reference"]["id"]
+    try:
+        instance = exo.wait_for_instance_state(instance_id, ["stopped"], timeout=3600)
+        if instance.state != "stopped":
+            raise ValueError(
+                f"build instance '{name}-build' did not power off "
+                f"(state '{instance.state}'), golden image not created"
+            )
+        snapshot = exo.wait_for_operation(exo.create_snapshot(instance_id))
+        must_succeed(snapshot, f"snapshotting '{name}-build'")
+        promoted = exo.wait_for_operation(
+            exo.promote_snapshot(
+                snapshot["reference"]["id"],
+                name,
+                default_user=base_template.default_user,
+            )
+        )
+        must_succeed(promoted, f"promoting snapshot to '{name}'")
+    finally:
+        exo.wait_for_operation(exo.destroy_instance(instance_id))
+    return exo.get_template(promoted["reference"]["id"])
+
+
+def must_succeed(operation, action):
+    if operation.get("state", "") != "success":
+        raise ValueError(f"{action} failed: operation {operation.get('state', '')}")
+
+
+def wait_until_ready(ctx, instances, password=False, timeout=900, exo=None):
+    exo = exo or ctx.obj["exo"]
+    not_ready = []
+    results = await_readiness(exo, instances, password, timeout)
+    for n, result in enumerate(results, 1):
+        eprint(f"{n}/{len(instances)}: {result['name']} {result['state']}")
+        emit(ctx, result)
+        if result["state"] != "ready":
+            not_ready.append(result["name"])
+    if not_ready:
+        fatal(f"not ready after {timeout}s: {', '.join(sorted(not_ready))}")
+
+
+def await_readiness(
+    exo, instances, password=False, timeout=900, interval=5, workers=max_workers
+):
+    template_ids = {i.template_id for i in instances} - {""}
+    families = {id: exo.get_template(id).family for id in template_ids}
+
+    def wait(instance):
+        family = families.get(instance.template_id, "")
+        port = 3389 if family == "windows" else 22
+        deadline = time.monotonic() + timeout
+        while True:
+            ip = instance.public_ip
+            if ip and is_port_open(ip, port):
+                if not password or exo.get_instance_password(instance.id):
+                    state = "ready"
+                    break
+            if time.monotonic() > deadline:
+                state = "timeout"
+                break
+            time.sleep(interval)
+            if not ip:
+                instance = exo.get_instance(instance.id, fresh=True)
+        return {"name": instance.name, "ip": ip, "port": port, "state": state}
+
+    for _instance, result in run_concurrently(wait, instances, workers):
+        yield result
+
+
+def watch_states(exo, selectors, targets, timeout=900, min_interval=2, max_interval=30):
+    previous = {}
+    interval = min_interval
+    deadline = time.monotonic() + timeout
+    while True:
+        exo.invalidate("instance")
+        current = {i.id: i for i in exo.get_instances_by(selectors)}
+        pending = {i.name for i in current.values() if i.state not in targets}
+        changed = False
+        for id, instance in current.items():
+            before = previous.get(id)
+            old_state = before.state if before else ""
+            old_ip = before.public_ip if before else ""
+            if (old_state, old_ip) != (instance.state, instance.public_ip):
+                changed = True
+                yield {
+                    "name": instance.name,
+                    "from": old_state,
+                    "to": instance.state,
+                    "ip": instance.public_ip,
+                }
+        for id in previous.keys() - current.keys():
+            changed = True
+            yield {
+                "name": previous[id].name,
+                "from": previous[id].state,
+                "to": "gone",
+                "ip": "",
+            }
+        previous = current
+        if not pending or time.monotonic() > deadline:
+            return
+        interval = min_interval if changed else min(interval * 2, max_interval)
+        time.sleep(min(interval, max(0, deadline - time.monotonic())))
+
+
+def roll_out(ctx, instances, change, wave_size=5, wait_ready=False, timeout=900):
+    exo = ctx.obj["exo"]
+
+    def succeeded(operation):
+        return exo.wait_for_operation(operation).get("state", "") == "success"
+
+    def update(instance):
+        was_running = instance.state == "running"
+        result = {"name": instance.name, "state": "success", "restarted": False}
+        if was_running and not succeeded(exo.stop_instance(instance.id)):
+            return {**result, "state": "stop failed"}
+        if not succeeded(change(instance)):
+            result["state"] = "change failed"
+        if was_running:
+            if succeeded(exo.start_instance(instance.id)):
+                result["restarted"] = True
+            elif result["state"] == "success":
+                result["state"] = "start failed"
+        return result
+
+    for start in range(0, len(instances), wave_size):
+        wave = instances[start : start + wave_size]
+        eprint(f"wave {start // wave_size + 1}: {', '.join(i.name for i in wave)}")
+        restarted = []
+        failed = []
+        for instance, result in run_concurrently(update, wave, wave_size):
+            emit(ctx, result)
+            if result["restarted"]:
+                restarted.append(instance)
+            if result["state"] != "success":
+                failed.append(result["name"])
+        if wait_ready and restarted:
+            wait_until_ready(ctx, restarted, timeout=timeout)
+        if failed:
+            fatal(f"rollout stopped, failed: {', '.join(sorted(failed))}")
+
+
+def relabel_instances(
+    exo, instances, add={}, remove=[], rename={}, workers=max_workers
+):
+    changes = {}
+    for instance in instances:
+        labels = change_labels(instance.labels, add, remove, rename)
+        if labels != instance.labels:
+            changes[instance.id] = labels
+    eprint(f"updating labels of {len(changes)} of {len(instances)} instances")
+    update = lambda id: exo.update_instance_labels(id, labels=changes[id])
+    for _id, result in run_concurrently(update, changes, workers):
+        yield result
+
+
+def teardown_scenario(exo, name, domain="", workers=max_workers):
+    def has_scenario(o):
+        return o.label("scenario") == name
+
+    instances = list(filter(has_scenario, exo.get_instances()))
+    networks = list(filter(has_scenario, exo.get_networks()))
+    records = []
+    if domain:
+        domain_id = exo.get_domain_id(domain)
+        freed_ips = {i.public_ip for i in instances if i.public_ip}
+        records = [
+            r
+            for r in exo.get_non_system_dns_records(domain_id)
+            if r.content in freed_ips
+        ]
+    detached = {i.id: threading.Event() for i in instances}
+    attached = {n.id: [] for n in networks}
+    for instance in instances:
+        for network_id in instance.private_network_ids:
+            attached.setdefault(network_id, []).append(instance.id)
+
+    def destroy_instance(instance):
+        try:
+            for network_id in instance.private_network_ids:
+                exo.wait_for_operation(exo.detach_network(network_id, instance.id))
+        finally:
+            detached[instance.id].set()
+        return exo.wait_for_operation(exo.destroy_instance(instance.id))
+
+    def delete_network(network):
+        for instance_id in attached[network.id]:
+            if instance_id in detached:
+                detached[instance_id].wait()
+        return exo.wait_for_operation(exo.delete_network(network.id))
+
+    instance_pool = ThreadPoolExecutor(max_workers=workers)
+    network_pool = ThreadPoolExecutor(max_workers=workers)
+    with instance_pool, network_pool:
+        futures = [instance_pool.submit(destroy_instance, i) for i in instances]
+        futures += [network_pool.submit(delete_network, n) for n in networks]
+        futures += [
+            network_pool.submit(exo.delete_dns_record, domain_id, r.id) for r in records
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def find_orphans(instances, networks, records=[], stale_scenarios=set()):
+    def scenario(o):
+        return o.label("scenario")
+
+    attached = {}
+    for instance in instances:
+        for network_id in instance.private_network_ids:
+            attached.setdefault(network_id, []).append(instance.id)
+    instance_scenarios = {scenario(i) for i in instances} - {""}
+    network_scenarios = {scenario(n) for n in networks} - {""}
+    dangling_scenarios = network_scenarios - instance_scenarios
+    orphaned_instances = [i for i in instances if scenario(i) in stale_scenarios]
+    orphaned_networks = [
+        n
+        for n in networks
+        if n.id not in attached
+        or scenario(n) in dangling_scenarios
+        or scenario(n) in stale_scenarios
+    ]
+    orphaned_ids = {i.id for i in orphaned_instances}
+    live_ips = {
+        i.public_ip for i in instances if i.public_ip and i.id not in orphaned_ids
+    }
+    managed_names = {i.name for i in instances}
+    orphaned_records = [
+        r
+        for r in records
+        if r.type == "A" and r.name in managed_names and r.content not in live_ips
+    ]
+    orphans = {
+        "instance": orphaned_instances,
+        "network": orphaned_networks,
+        "record": orphaned_records,
+    }
+    return orphans, attached
+
+
 def get_image_names(ctx, contains=""):
     exo = ctx.obj["exo"]
     templates = exo.list_templates()
-    names = sorted(map(lambda t: t["name"], templates))
+    names = sorted(map(lambda t: t.name, templates))
     if contains:
         names = filter(lambda n: contains.strip().lower() in n.lower(), names)
     return list(names)
@@ -749,26 +1860,26 @@ def get_networks(ctx, contains=""):
     exo = ctx.obj["exo"]
     nets = exo.get_networks()
     if contains:
-        nets = filter(lambda n: contains.strip().lower() in n["name"].lower(), nets)
+        nets = filter(lambda n: contains.strip().lower() in n.name.lower(), nets)
     return list(nets)
 
 
 def validate_scenario(exo, scenario_data):
     for field in ["name", "instances"]:
         if field not in scenario_data:
-            fatal(f"missing required field '{field}' in scenario file")
+            raise ValueError(f"missing required field '{field}' in scenario file")
     instance_data = scenario_data["instances"]
     required_images = set(map(lambda i: i["image"], instance_data))
     image_templates = exo.list_templates()
-    available_images = set([t["name"] for t in image_templates])
-    image_family_by_name = {t["name"]: t["family"] for t in image_templates}
+    available_images = set([t.name for t in image_templates])
+    image_family_by_name = {t.name: t.family for t in image_templates}
     missing_images = required_images - available_images
     if missing_images:
-        fatal(f"no such image(s): {missing_images}")
+        raise ValueError(f"no such image(s): {missing_images}")
     required_sizes = set(map(lambda i: i["size"], instance_data))
     missing_sizes = required_sizes - set(sizes)
     if missing_sizes:
-        fatal(f"no such size(s): {missing_sizes}")
+        raise ValueError(f"no such size(s): {missing_sizes}")
     image_families = {}
     kinds = {
         "debian": "linux",
@@ -786,40 +1897,28 @@ def validate_scenario(exo, scenario_data):
 
 
 def determine_instances(instance_data, user_data):
-    def with_canonical_hostname(entry):
-        instance_name = entry["instance"]["name"]
-        user_name = entry["user"]["name"]
+    def with_canonical_hostname(instance, user):
+        instance_name = instance["name"]
         return {
             "name": instance_name,
-            "canonical_name": to_host_name(f"{instance_name}_{user_name}"),
-            "size": entry["instance"]["size"],
-            "image": entry["instance"]["image"],
+            "canonical_name": to_host_name(f"{instance_name}_{user['name']}"),
+            "size": instance["size"],
+            "image": instance["image"],
         }
 
-    instances_needed = [
-        {"instance": i, "user": u} for i in instance_data for u in user_data
-    ]
     return {
-        u["name"]: [
-            with_canonical_hostname(e)
-            for e in instances_needed
-            if e["user"]["name"] == u["name"]
-        ]
+        u["name"]: [with_canonical_hostname(i, u) for i in instance_data]
         for u in user_data
     }
 
 
 def determine_networks(network_data, user_data, instances_by_username):
-    def with_canonical_netname(entry, instances_by_username):
-        network_name = entry["network"]["name"]
-        user_name = entry["user"]["name"]
-        connect_hosts = entry["network"]["connects"]
-        host_ips = {e["name"]: e["ip"] for e in connect_hosts}
-        net = entry["network"]
+    def with_canonical_netname(network, user_name, instances):
+        network_name = network["name"]
         ip_config = {
-            "netmask": net.get("netmask", ""),
-            "start-ip": net.get("start-ip", ""),
-            "end-ip": net.get("end-ip", ""),
+            "netmask": network.get("netmask", ""),
+            "start-ip": network.get("start-ip", ""),
+            "end-ip": network.get("end-ip", ""),
         }
         ip_config = ip_config if all(ip_config.values()) else {}
         return {
@@ -829,54 +1928,114 @@ def determine_networks(network_data, user_data, instances_by_username):
             "connects": [
                 {
                     "canonical_name": instance["canonical_name"],
-                    "ip": host_ips[instance["name"]],
+                    "ip": host_ips[network_name][instance["name"]],
                 }
-                for instance_username, instances in instances_by_username.items()
                 for instance in instances
-                if instance["name"] in host_ips.keys()
-                and instance_username == user_name
+                if instance["name"] in host_ips[network_name]
             ],
         }
 
-    networks_needed = [
-        {"network": n, "user": u} for n in network_data for u in user_data
-    ]
+    host_ips = {
+        n["name"]: {e["name"]: e.get("ip", "") for e in n["connects"]}
+        for n in network_data
+    }
     return {
         u["name"]: [
-            with_canonical_netname(e, instances_by_username)
-            for e in networks_needed
-            if e["user"]["name"] == u["name"]
+            with_canonical_netname(
+                n, u["name"], instances_by_username.get(u["name"], [])
+            )
+            for n in network_data
         ]
         for u in user_data
     }
 
 
-def determine_attachments(exo, networks_by_username):
-    networks = exo.get_networks()
-    instances = exo.get_instances()
-    all_networks = reduce(lambda acc, e: acc + e, networks_by_username.values())
+def plan_attachments(mapping, instances, networks):
+    if not isinstance(mapping, dict):
+        raise ValueError("mapping must map instance names to networks")
+    instances_by_name = {}
+    for instance in instances:
+        instances_by_name.setdefault(instance.name, []).append(instance)
+    networks_by_name = {}
+    for network in networks:
+        networks_by_name.setdefault(network.name, []).append(network)
+    instance_names = {i.id: i.name for i in instances}
+    problems = []
+    ranges = {}
     attachments = []
-    for network_data in all_networks:
-        name = network_data["canonical_name"]
-        connects = network_data["connects"]
-        network = next(filter(lambda n: n["name"] == name, networks))
-        network_id = network["id"]
-        for connect in connects:
-            instance_id = next(
-                filter(lambda i: i["name"] == connect["canonical_name"], instances)
-            )["id"]
+    for instance_name, network_ips in mapping.items():
+        matches = instances_by_name.get(instance_name, [])
+        if len(matches) != 1:
+            problems.append(f"instance '{instance_name}' not found or not unique")
+            continue
+        instance = matches[0]
+        if not isinstance(network_ips, dict):
+            problems.append(f"instance '{instance_name}': networks must be a mapping")
+            continue
+        for network_name, ip in network_ips.items():
+            matches = networks_by_name.get(network_name, [])
+            if len(matches) != 1:
+                problems.append(f"network '{network_name}' not found or not unique")
+                continue
+            network = matches[0]
+            if network.id in instance.private_network_ids:
+                problems.append(
+                    f"'{instance_name}' already attached to '{network_name}'"
+                )
+                continue
+            ip = str(ip or "").strip()
+            if ip in network.leases:
+                holder = instance_names.get(network.leases[ip], network.leases[ip])
+                problems.append(
+                    f"network '{network_name}', '{instance_name}': "
+                    f"{ip} is already leased to '{holder}'"
+                )
+                continue
+            if ip:
+                try:
+                    if network.id not in ranges:
+                        ranges[network.id] = network_range(network)
+                    ip = ranges[network.id].reserve(ip)
+                except ValueError as e:
+                    problems.append(f"network '{network_name}', '{instance_name}': {e}")
+                    continue
             attachments.append(
                 {
-                    "network_id": network_id,
-                    "instance_id": instance_id,
-                    "ip": connect["ip"],
+                    "instance": instance_name,
+                    "network": network_name,
+                    "instance_id": instance.id,
+                    "network_id": network.id,
+                    "ip": ip,
                 }
             )
+    if problems:
+        raise ValueError("; ".join(problems))
     return attachments
 
 
-def to_host_name(name):
-    return name.replace(".", "-").replace("_", "-")
+def network_range(network):
+    if not (network.start_ip and network.end_ip and network.netmask):
+        raise ValueError("static IPs require a managed network")
+    address_range = AddressRange(network.start_ip, network.end_ip, network.netmask)
+    for ip in network.leases:
+        if ipaddress.IPv4Address(ip) in address_range:
+            address_range.reserve(ip)
+    return address_range
+
+
+def determine_attachments(exo, networks_by_username):
+    network_ids = {n.name: n.id for n in exo.get_networks()}
+    instance_ids = {i.name: i.id for i in exo.get_instances()}
+    return [
+        {
+            "network_id": network_ids[network_data["canonical_name"]],
+            "instance_id": instance_ids[connect["canonical_name"]],
+            "ip": connect["ip"],
+        }
+        for networks in networks_by_username.values()
+        for network_data in networks
+        for connect in network_data["connects"]
+    ]
 
 
 def sanitize_name(name):
@@ -907,6 +2066,18 @@ def is_available_image(ctx, name):
     return name in get_image_names(ctx)
 
 
+def emit(ctx, record):
+    try:
+        ctx.obj["output"].emit(record)
+    except ValueError as e:
+        fatal(str(e))
+
+
+def must_have_one_shape(ctx, wait_ready):
+    if wait_ready and ctx.obj["output"].format == "csv":
+        fatal("--wait-ready mixes result types, use --output jsonl or table")
+
+
 def eprint(message):
     print(message, file=sys.stderr)
 
@@ -919,11 +2090,11 @@ def fatal(message):
 def extract_instance_info(instance, fields):
     info = {}
     for key in fields:
-        info[key] = instance.get(key, "")
+        info[key] = getattr(instance, key, "")
     return info
 
 
 def prepare_cloud_init_data(cloud_config={}, data={}):
     template = Template(yaml.dump(cloud_config))
-    cloud_init_data = yaml.load(template.render(data), yaml.SafeLoader)
+    cloud_init_data = load_yaml(template.render(data))
     return cloud_init_data
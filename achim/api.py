@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import dotenv_values
+
+from achim.achim import (
+    WarmPool,
+    default_image,
+    fill_pool,
+    max_workers,
+    plan_group,
+    provision_group,
+    provision_scenario,
+    register_keys,
+    resolve_instance_spec,
+    sizes,
+    validate_scenario,
+)
+from achim.exoscale import Exoscale
+from achim.loader import check_host_names, validate_group, validate_scenario_schema
+from achim.scheduler import place_scenario
+from achim.utils import parse_label_value_arg, run_concurrently
+
+
+class Achim:
+    def __init__(self, config=None, workers=max_workers):
+        self.config = config if config is not None else dotenv_values(".env")
+        self.exo = Exoscale(self.config)
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def refresh(self):
+        self.exo.invalidate()
+
+    def instances(self):
+        return self.exo.get_instances()
+
+    def networks(self):
+        return self.exo.get_networks()
+
+    def templates(self):
+        return self.exo.list_templates()
+
+    def select(self, selector={}):
+        if isinstance(selector, str):
+            selector = parse_label_value_arg(selector) if selector else {}
+        return [i for i in self.instances() if i.matches(selector)]
+
+    def create_group(
+        self,
+        group,
+        keyname,
+        context="default",
+        autostart=False,
+        image=default_image,
+        size="micro",
+        ignore_existing=False,
+        use_pool=False,
+        user_keys=False,
+    ):
+        if image not in {t.name for t in self.templates()}:
+            raise ValueError(f"no such image '{image}'")
+        if size not in sizes:
+            raise ValueError(f"no such size '{size}', use one of {sizes}")
+        validate_group(group)
+        existing_names = {i.name for i in self.instances()}
+        users = plan_group(group, existing_names, ignore_existing)
+        keys = self.register_keys(users) if user_keys else {}
+        pool = WarmPool(self.exo) if use_pool else None
+        results = list(
+            provision_group(
+                self.exo,
+                group,
+                users,
+                keyname,
+                context,
+                autostart,
+                image,
+                size,
+                executor=self.pool,
+                pool=pool,
+                user_keys=keys,
+            )
+        )
+        self.refresh()
+        return results
+
+    def apply_scenario(
+        self,
+        scenario,
+        group,
+        keyname,
+        context="default",
+        autostart=False,
+        use_pool=False,
+        user_keys=False,
+    ):
+        scenario = validate_scenario_schema(scenario)
+        check_host_names(scenario, validate_group(group))
+        validate_scenario(self.exo, scenario)
+        zone = self.config.get("EXOSCALE_ZONE", "")
+        place_scenario(group["users"], scenario, {zone: self.exo.get_quotas()})
+        network_data = scenario.get("networks", [])
+        keys = self.register_keys(group["users"]) if user_keys else {}
+        pool = WarmPool(self.exo) if use_pool else None
+        results = list(
+            provision_scenario(
+                self.exo,
+                scenario,
+                network_data,
+                group,
+                keyname,
+                context,
+                autostart,
+                executor=self.pool,
+                pool=pool,
+                user_keys=keys,
+            )
+        )
+        self.refresh()
+        return results
+
+    def fill_pool(self, keyname, count, image=default_image, size="micro"):
+        if size not in sizes:
+            raise ValueError(f"no such size '{size}', use one of {sizes}")
+        spec = resolve_instance_spec(self.exo, image, size, keyname)
+        results = list(fill_pool(self.exo, spec, count, self.workers))
+        self.refresh()
+        return results
+
+    def register_keys(self, users):
+        return register_keys(self.config, self.exo, users, self.workers)
+
+    def bulk(self, selector, action):
+        actions = {
+            "start": self.exo.start_instance,
+            "stop": self.exo.stop_instance,
+            "destroy": self.exo.destroy_instance,
+            "protect": self.exo.protect_instance,
+            "deprotect": self.exo.deprotect_instance,
+        }
+        if isinstance(action, str):
+            if action not in actions:
+                raise ValueError(f"unknown action '{action}', use one of {[*actions]}")
+            run = lambda instance: actions[action](instance.id)
+        else:
+            run = lambda instance: action(self.exo, instance)
+        results = [
+            result
+            for _instance, result in run_concurrently(
+                run, self.select(selector), executor=self.pool
+            )
+        ]
+        self.refresh()
+        return results
@@ -1,28 +1,56 @@
+from concurrent.futures import Future
 from exoscale_auth import ExoscaleV2Auth
 import requests
 import base64
+import re
+import threading
+import time
 
 import yaml
 
+from achim.models import DnsRecord, Instance, Network, Template
+
+uncached = re.compile(r"^operation/|:password$")
+related_resources = {
+    "instance": {"private-network"},
+    "private-network": {"instance"},
+    "snapshot": {"template"},
+}
+
 
 class Exoscale:
-    def __init__(self, config):
+    def __init__(self, config, names=None):
+        self.names = names
         self.auth = ExoscaleV2Auth(
             config["EXOSCALE_API_KEY"], config["EXOSCALE_API_SECRET"]
         )
         url_prefix = f"api-{config['EXOSCALE_ZONE']}"
         self.base_url = f"https://{url_prefix}.exoscale.com/v2"
+        self.cache = {}
+        self.cache_lock = threading.Lock()
 
     def list_templates(self):
-        return self.get("template").json()["templates"]
+        templates = self.get("template").json()["templates"]
+        templates = [Template.from_json(t) for t in templates]
+        if self.names:
+            self.names.remember_images(templates)
+        return templates
+
+    def list_private_templates(self):
+        templates = self.get("template?visibility=private").json()["templates"]
+        return [Template.from_json(t) for t in templates]
 
     def get_template_by_name(self, name):
-        templates = self.get("template").json()["templates"]
-        matches = filter(lambda t: t["name"] == name, templates)
-        return next(matches)
+        templates = self.list_templates()
+        matches = filter(lambda t: t.name == name, templates)
+        match = next(matches, None)
+        if match is None:
+            matches = filter(lambda t: t.name == name, self.list_private_templates())
+            match = next(matches)
+        return match
 
     def get_template(self, id):
-        return self.get(f"template/{id}").json()
+        return Template.from_json(self.get(f"template/{id}").json())
 
     def get_instance_types(self, rules):
         def filter_rule(instance_type, key, value):
@@ -35,19 +63,18 @@ class Exoscale:
         )
         return list(filtered_types)
 
+    def get_instance(self, id, fresh=False):
+        return Instance.from_json(self.get(f"instance/{id}", fresh).json())
+
     def get_instances(self):
-        return self.get("instance").json()["instances"]
+        instances = self.get("instance").json()["instances"]
+        instances = [Instance.from_json(i) for i in instances]
+        if self.names:
+            self.names.remember_instances(instances)
+        return instances
 
     def get_instances_by(self, selectors):
-        instances = self.get("instance").json()["instances"]
-        selected = []
-        for instance in instances:
-            instance_labels = {
-                k: v for (k, v) in instance.get("labels", {}).items() if k in selectors
-            }
-            if instance_labels == selectors:
-                selected.append(instance)
-        return selected
+        return [i for i in self.get_instances() if i.matches(selectors)]
 
     def start_instance(self, id):
         return self.put(f"instance/{id}:start").json()
@@ -67,9 +94,24 @@ class Exoscale:
     def update_instance_labels(self, id, labels={}):
         return self.put(f"instance/{id}", {"labels": labels}).json()
 
+    def create_snapshot(self, id):
+        return self.put(f"instance/{id}:create-snapshot").json()
+
+    def promote_snapshot(self, id, name, default_user=""):
+        payload = {"name": name, "default-user": default_user}
+        payload = {k: v for k, v in payload.items() if v}
+        return self.post(f"snapshot/{id}:promote", payload).json()
+
     def get_ssh_key(self, name):
         return self.get(f"ssh-key/{name}").json()
 
+    def list_ssh_keys(self):
+        return self.get("ssh-key").json()["ssh-keys"]
+
+    def register_ssh_key(self, name, public_key):
+        payload = {"name": name, "public-key": public_key}
+        return self.post("ssh-key", payload).json()
+
     def get_instance_password(self, id):
         res = self.get(f"instance/{id}:password")
         return res.json()["password"] if res.status_code == 200 else ""
@@ -83,7 +125,8 @@ class Exoscale:
 
     def get_non_system_dns_records(self, id):
         records = self.get(f"dns-domain/{id}/record").json()["dns-domain-records"]
-        return list(filter(lambda r: r.get("system-record", True) == False, records))
+        records = [DnsRecord.from_json(r) for r in records]
+        return [r for r in records if not r.system]
 
     def delete_dns_record(self, domain_id, record_id):
         return self.delete(f"dns-domain/{domain_id}/record/{record_id}").json()
@@ -105,23 +148,25 @@ class Exoscale:
         cloud_init_data={},
     ):
         bytes_to_gb = lambda b: int(b / 1024**3)
-        cloud_init_dump = yaml.dump(cloud_init_data, Dumper=yaml.Dumper)
-        cloud_init_bytes = ("#cloud-config\n" + cloud_init_dump).encode(
-            encoding="utf-8"
-        )
-        cloud_init_base64 = base64.b64encode(cloud_init_bytes).decode(encoding="utf-8")
         payload = {
             "auto-start": autostart,
             "name": name,
             "instance-type": instance_type,
-            "template": template,
+            "template": {"id": template.id},
             "ssh-key": {"name": ssh_key["name"]},
-            "disk-size": bytes_to_gb(template["size"]) if "size" in template else 10,
+            "disk-size": bytes_to_gb(template.size) if template.size else 10,
             "labels": labels,
-            "user-data": cloud_init_base64,
+            "user-data": encode_cloud_init(cloud_init_data),
         }
         return self.post("instance", payload).json()
 
+    def update_instance(self, id, name="", labels=None, cloud_init_data=None):
+        payload = {"name": name, "labels": labels}
+        if cloud_init_data is not None:
+            payload["user-data"] = encode_cloud_init(cloud_init_data)
+        payload = {k: v for k, v in payload.items() if v is not None and v != ""}
+        return self.put(f"instance/{id}", payload).json()
+
     def create_network(
         self,
         name,
@@ -143,7 +188,11 @@ class Exoscale:
         return self.post("private-network", payload).json()
 
     def get_networks(self):
-        return self.get("private-network").json()["private-networks"]
+        networks = self.get("private-network").json()["private-networks"]
+        networks = [Network.from_json(n) for n in networks]
+        if self.names:
+            self.names.remember_networks(networks)
+        return networks
 
     def attach_network(self, network_id, instance_id, ip):
         payload = {
@@ -155,11 +204,15 @@ class Exoscale:
         payload = {k: v for k, v in payload.items() if v}
         return self.put(f"private-network/{network_id}:attach", payload).json()
 
+    def detach_network(self, network_id, instance_id):
+        payload = {"instance": {"id": instance_id}}
+        return self.put(f"private-network/{network_id}:detach", payload).json()
+
     def delete_network(self, network):
         return self.delete(f"private-network/{network}").json()
 
     def get_network(self, id):
-        return self.get(f"private-network/{id}").json()
+        return Network.from_json(self.get(f"private-network/{id}").json())
 
     def resize_disk(self, id, size):
         return self.put(f"instance/{id}:resize-disk", {"disk-size": size}).json()
@@ -167,25 +220,106 @@ class Exoscale:
     def scale_instance(self, id, type):
         return self.put(f"instance/{id}:scale", {"instance-type": type}).json()
 
+    def get_quotas(self):
+        return self.get("quota").json()["quotas"]
+
+    def get_operation(self, id):
+        return self.get(f"operation/{id}").json()
+
+    def wait_for_operation(self, operation, interval=2, timeout=600):
+        if operation.get("state", "") != "pending":
+            return operation
+        deadline = time.monotonic() + timeout
+        while operation.get("state", "") == "pending" and time.monotonic() < deadline:
+            time.sleep(interval)
+            operation = self.get_operation(operation["id"])
+        link = operation.get("reference", {}).get("link", "")
+        if link:
+            self.invalidate_for(link.split("/v2/", 1)[-1].lstrip("/"))
+        else:
+            self.invalidate()
+        return operation
+
+    def wait_for_instance_state(self, id, states, interval=5, timeout=600):
+        deadline = time.monotonic() + timeout
+        instance = self.get_instance(id, fresh=True)
+        while instance.state not in states and time.monotonic() < deadline:
+            time.sleep(interval)
+            instance = self.get_instance(id, fresh=True)
+        return instance
+
     def suffix_url(self, suffix):
         return f"{self.base_url}/{suffix}"
 
-    def get(self, suffix):
+    def invalidate(self, *resources):
+        with self.cache_lock:
+            if not resources:
+                self.cache.clear()
+                return
+            for suffix in [s for s in self.cache if resource_of(s) in resources]:
+                del self.cache[suffix]
+
+    def invalidate_for(self, suffix):
+        resource = resource_of(suffix)
+        self.invalidate(resource, *related_resources.get(resource, ()))
+
+    def get(self, suffix, fresh=False):
         headers = {"Content-Type": "application/json"}
         url = self.suffix_url(suffix)
-        return requests.get(url, auth=self.auth, headers=headers)
+        if fresh or uncached.search(suffix):
+            return requests.get(url, auth=self.auth, headers=headers)
+        with self.cache_lock:
+            pending = self.cache.get(suffix)
+            if pending is None:
+                pending = self.cache[suffix] = Future()
+                fetch = True
+            else:
+                fetch = False
+        if not fetch:
+            return pending.result()
+        try:
+            res = requests.get(url, auth=self.auth, headers=headers)
+        except Exception as e:
+            self.forget(suffix, pending)
+            pending.set_exception(e)
+            raise
+        if res.status_code != 200:
+            self.forget(suffix, pending)
+        pending.set_result(res)
+        return res
+
+    def forget(self, suffix, pending):
+        with self.cache_lock:
+            if self.cache.get(suffix) is pending:
+                del self.cache[suffix]
 
     def post(self, suffix, payload):
         headers = {"Content-Type": "application/json"}
         url = self.suffix_url(suffix)
-        return requests.post(url, json=payload, auth=self.auth, headers=headers)
+        res = requests.post(url, json=payload, auth=self.auth, headers=headers)
+        self.invalidate_for(suffix)
+        return res
 
     def put(self, suffix, payload=None):
         headers = {"Content-Type": "application/json"}
         url = self.suffix_url(suffix)
-        return requests.put(url, json=payload, auth=self.auth, headers=headers)
+        res = requests.put(url, json=payload, auth=self.auth, headers=headers)
+        self.invalidate_for(suffix)
+        return res
 
     def delete(self, suffix):
         headers = {"Content-Type": "application/json"}
         url = self.suffix_url(suffix)
-        return requests.delete(url, auth=self.auth, headers=headers)
+        res = requests.delete(url, auth=self.auth, headers=headers)
+        self.invalidate_for(suffix)
+        return res
+
+
+def resource_of(suffix):
+    return re.split(r"[/:?]", suffix, maxsplit=1)[0]
+
+
+def encode_cloud_init(cloud_init_data):
+    cloud_init_dump = yaml.dump(cloud_init_data, Dumper=yaml.Dumper)
+    cloud_init_bytes = ("#cloud-config\n" + cloud_init_dump).encode(encoding="utf-8")
+    return base64.b64encode(cloud_init_bytes).decode(encoding="utf-8")
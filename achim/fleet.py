@@ -0,0 +1,142 @@
+import csv
+import gzip
+import importlib.util
+
+formats = ["parquet", "arrow", "csv"]
+extensions = {
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+    ".csv.gz": "csv",
+    ".csv": "csv",
+    ".gz": "csv",
+}
+batch_size = 1000
+base_columns = [
+    "snapshot_at",
+    "zone",
+    "id",
+    "name",
+    "state",
+    "public_ip",
+    "instance_type_id",
+    "instance_type_family",
+    "instance_type_size",
+    "cpus",
+    "memory",
+    "template_id",
+    "template_name",
+    "template_family",
+    "private_networks",
+]
+int_columns = {"cpus", "memory"}
+
+
+def default_format():
+    return "parquet" if importlib.util.find_spec("pyarrow") else "csv"
+
+
+def extension_format(path):
+    name = path.lower()
+    for extension, format in extensions.items():
+        if name.endswith(extension):
+            return format
+    return None
+
+
+def resolve_format(path, format=None):
+    inferred = extension_format(path)
+    if format and inferred and format != inferred:
+        raise ValueError(f"format '{format}' does not match file name '{path}'")
+    return format or inferred or default_format()
+
+
+def fleet_columns(instances):
+    label_keys = {k for i in instances for k in i.labels}
+    return base_columns + [f"label_{k}" for k in sorted(label_keys)]
+
+
+def fleet_rows(snapshot_at, zone, instances, types, templates, networks):
+    for instance in instances:
+        instance_type = types.get(instance.instance_type_id, {})
+        template = templates.get(instance.template_id)
+        row = {
+            "snapshot_at": snapshot_at,
+            "zone": zone,
+            "id": instance.id,
+            "name": instance.name,
+            "state": instance.state,
+            "public_ip": instance.public_ip,
+            "instance_type_id": instance.instance_type_id,
+            "instance_type_family": instance_type.get("family", ""),
+            "instance_type_size": instance_type.get("size", ""),
+            "cpus": instance_type.get("cpus"),
+            "memory": instance_type.get("memory"),
+            "template_id": instance.template_id,
+            "template_name": template.name if template else "",
+            "template_family": template.family if template else "",
+            "private_networks": ",".join(
+                networks.get(id, id) for id in instance.private_network_ids
+            ),
+        }
+        for key, value in instance.labels.items():
+            row[f"label_{key}"] = value
+        yield row
+
+
+def batched(rows, size=batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_fleet(path, format, columns, rows, size=batch_size):
+    if format not in formats:
+        raise ValueError(f"unknown format '{format}', use one of {formats}")
+    if format == "csv":
+        return write_csv(path, columns, rows, size)
+    if not importlib.util.find_spec("pyarrow"):
+        raise ValueError(f"format '{format}' requires pyarrow, use csv instead")
+    return write_arrow(path, format, columns, rows, size)
+
+
+def write_csv(path, columns, rows, size):
+    count = 0
+    opener = open if path.lower().endswith(".csv") else gzip.open
+    with opener(path, "wt", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for batch in batched(rows, size):
+            writer.writerows([row.get(c, "") for c in columns] for row in batch)
+            count += len(batch)
+    return count
+
+
+def write_arrow(path, format, columns, rows, size):
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    def column_type(column):
+        if column == "snapshot_at":
+            return pyarrow.timestamp("s", tz="UTC")
+        return pyarrow.int64() if column in int_columns else pyarrow.string()
+
+    schema = pyarrow.schema([(c, column_type(c)) for c in columns])
+    if format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression="zstd")
+    else:
+        writer = pyarrow.ipc.new_file(path, schema)
+    count = 0
+    with writer:
+        for batch in batched(rows, size):
+            data = {c: [row.get(c) for row in batch] for c in columns}
+            writer.write_batch(pyarrow.RecordBatch.from_pydict(data, schema=schema))
+            count += len(batch)
+    return count
@@ -0,0 +1,84 @@
+import ipaddress
+
+
+class AddressRange:
+    def __init__(self, start_ip, end_ip, netmask):
+        try:
+            start = ipaddress.IPv4Address(start_ip.strip())
+            end = ipaddress.IPv4Address(end_ip.strip())
+            network = ipaddress.IPv4Network(f"{start}/{netmask.strip()}", strict=False)
+        except ValueError as e:
+            raise ValueError(f"invalid range {start_ip}-{end_ip}/{netmask}: {e}")
+        if end < start:
+            raise ValueError(f"end-ip {end} lies before start-ip {start}")
+        if end not in network:
+            raise ValueError(f"end-ip {end} lies outside of network {network}")
+        self.network = network
+        self.start = int(start)
+        self.size = int(end) - self.start + 1
+        self.used = 0
+
+    def __contains__(self, ip):
+        return 0 <= int(ip) - self.start < self.size
+
+    def reserve(self, ip_str):
+        try:
+            ip = ipaddress.IPv4Address(ip_str.strip())
+        except ValueError:
+            raise ValueError(f"{ip_str} is not a valid IPv4 address")
+        if ip not in self:
+            raise ValueError(f"{ip} lies outside of {self}")
+        bit = 1 << (int(ip) - self.start)
+        if self.used & bit:
+            raise ValueError(f"{ip} is assigned more than once")
+        self.used |= bit
+        return str(ip)
+
+    def allocate(self):
+        free = ~self.used & (self.used + 1)
+        offset = free.bit_length() - 1
+        if offset >= self.size:
+            raise ValueError(f"no free address left in {self}")
+        self.used |= free
+        return str(ipaddress.IPv4Address(self.start + offset))
+
+    def __str__(self):
+        end = ipaddress.IPv4Address(self.start + self.size - 1)
+        return f"{ipaddress.IPv4Address(self.start)}-{end}"
+
+
+def allocate_scenario_ips(network_data):
+    problems = []
+    allocated = []
+    for network in network_data:
+        name = network.get("name", "")
+        connects = network.get("connects", [])
+        ip_config = [network.get(k, "") for k in ["start-ip", "end-ip", "netmask"]]
+        if not all(ip_config):
+            allocated.append(network)
+            continue
+        try:
+            address_range = AddressRange(*ip_config)
+        except ValueError as e:
+            problems.append(f"network '{name}': {e}")
+            continue
+        ips = {}
+        for connect in connects:
+            if not connect.get("ip"):
+                continue
+            try:
+                ips[connect["name"]] = address_range.reserve(connect["ip"])
+            except ValueError as e:
+                problems.append(f"network '{name}', '{connect['name']}': {e}")
+        for connect in connects:
+            if connect["name"] in ips:
+                continue
+            try:
+                ips[connect["name"]] = address_range.allocate()
+            except ValueError as e:
+                problems.append(f"network '{name}', '{connect['name']}': {e}")
+        connects = [{**c, "ip": ips.get(c["name"], "")} for c in connects]
+        allocated.append({**network, "connects": connects})
+    if problems:
+        raise ValueError("; ".join(problems))
+    return allocated
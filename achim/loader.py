@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+
+import yaml
+
+from achim.ipam import allocate_scenario_ips
+from achim.utils import cache_dir, to_host_name
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+cache_version = "1"
+
+
+def load_yaml(content):
+    return yaml.load(content, Loader=Loader)
+
+
+def load_group(file):
+    return load_cached(file.read(), "group", validate_group)
+
+
+def load_scenario(file):
+    return load_cached(file.read(), "scenario", validate_scenario_schema)
+
+
+def load_cached(content, kind, validate):
+    digest = hashlib.sha256(f"{kind}:{cache_version}:{content}".encode("utf-8"))
+    path = ""
+    try:
+        path = os.path.join(cache_dir("parsed"), f"{kind}-{digest.hexdigest()}.json")
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    data = validate(load_yaml(content))
+    if path:
+        try:
+            text = json.dumps(data)
+            if json.loads(text) != data:
+                return data
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(f"{path}.tmp", path)
+        except (OSError, TypeError, ValueError):
+            pass
+    return data
+
+
+def validate_group(group):
+    if not isinstance(group, dict):
+        raise ValueError("groups file must contain a mapping")
+    problems = []
+    if not group.get("name"):
+        problems.append("missing group name")
+    users = group.get("users")
+    if not isinstance(users, list) or not users:
+        problems.append("missing users")
+        users = []
+    if not isinstance(group.get("cloud-config", {}), dict):
+        problems.append("cloud-config must be a mapping")
+    names = set()
+    host_names = {}
+    for n, user in enumerate(users, 1):
+        name = user.get("name", "") if isinstance(user, dict) else ""
+        if not name:
+            problems.append(f"user #{n} has no name")
+            continue
+        if name in names:
+            problems.append(f"duplicate user name '{name}'")
+        names.add(name)
+        host_name = to_host_name(name)
+        if host_name in host_names and host_names[host_name] != name:
+            problems.append(
+                f"users '{host_names[host_name]}' and '{name}' share host name "
+                f"'{host_name}'"
+            )
+        host_names.setdefault(host_name, name)
+    if problems:
+        raise ValueError("; ".join(problems))
+    return group
+
+
+def validate_scenario_schema(scenario):
+    if not isinstance(scenario, dict):
+        raise ValueError("scenario file must contain a mapping")
+    problems = []
+    for field in ["name", "instances"]:
+        if not scenario.get(field):
+            problems.append(f"missing required field '{field}'")
+    instance_names = set()
+    for n, instance in enumerate(scenario.get("instances") or [], 1):
+        missing = [k for k in ["name", "image", "size"] if not instance.get(k)]
+        if missing:
+            problems.append(f"instance #{n} lacks {', '.join(missing)}")
+        name = instance.get("name", "")
+        if name in instance_names:
+            problems.append(f"duplicate instance name '{name}'")
+        instance_names.add(name)
+    network_names = set()
+    for network in scenario.get("networks") or []:
+        name = network.get("name", "")
+        if not name:
+            problems.append("network without name")
+        if name in network_names:
+            problems.append(f"duplicate network name '{name}'")
+        network_names.add(name)
+        connected = set()
+        for connect in network.get("connects") or []:
+            instance = connect.get("name", "")
+            if instance not in instance_names:
+                problems.append(f"network '{name}' connects unknown '{instance}'")
+            if instance in connected:
+                problems.append(f"network '{name}' connects '{instance}' twice")
+            connected.add(instance)
+    if not problems:
+        try:
+            networks = allocate_scenario_ips(scenario.get("networks") or [])
+            scenario = {**scenario, "networks": networks}
+        except ValueError as e:
+            problems.append(str(e))
+    if problems:
+        raise ValueError("; ".join(problems))
+    return scenario
+
+
+def check_host_names(scenario, group):
+    problems = []
+    for kind in ["instances", "networks"]:
+        names = {}
+        for user in group["users"]:
+            for entry in scenario.get(kind) or []:
+                canonical = to_host_name(f"{entry['name']}_{user['name']}")
+                owner = (entry["name"], user["name"])
+                if names.setdefault(canonical, owner) != owner:
+                    problems.append(f"name '{canonical}' is not unique")
+    if problems:
+        raise ValueError("; ".join(problems))
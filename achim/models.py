@@ -0,0 +1,175 @@
+import sys
+
+
+def intern_labels(labels):
+    return {sys.intern(k): sys.intern(v) for k, v in labels.items()}
+
+
+class Instance:
+    __slots__ = (
+        "id",
+        "name",
+        "state",
+        "labels",
+        "public_ip",
+        "template_id",
+        "instance_type_id",
+        "ssh_key",
+        "private_network_ids",
+    )
+
+    def __init__(
+        self,
+        id,
+        name,
+        state="",
+        labels={},
+        public_ip="",
+        template_id="",
+        instance_type_id="",
+        ssh_key="",
+        private_network_ids=(),
+    ):
+        self.id = id
+        self.name = name
+        self.state = state
+        self.labels = labels
+        self.public_ip = public_ip
+        self.template_id = template_id
+        self.instance_type_id = instance_type_id
+        self.ssh_key = ssh_key
+        self.private_network_ids = private_network_ids
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["id"],
+            data.get("name", ""),
+            sys.intern(data.get("state", "")),
+            intern_labels(data.get("labels", {})),
+            data.get("public-ip", ""),
+            sys.intern(data.get("template", {}).get("id", "")),
+            sys.intern(data.get("instance-type", {}).get("id", "")),
+            sys.intern(data.get("ssh-key", {}).get("name", "")),
+            tuple(n["id"] for n in data.get("private-networks", [])),
+        )
+
+    def label(self, key, default=""):
+        return self.labels.get(key, default)
+
+    def matches(self, selectors):
+        return all(self.labels.get(k) == v for k, v in selectors.items())
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "state": self.state,
+            "labels": self.labels,
+            "public-ip": self.public_ip,
+            "template": self.template_id,
+            "instance-type": self.instance_type_id,
+            "ssh-key": self.ssh_key,
+            "private-networks": list(self.private_network_ids),
+        }
+
+
+class Network:
+    __slots__ = ("id", "name", "labels", "start_ip", "end_ip", "netmask", "leases")
+
+    def __init__(
+        self, id, name, labels={}, start_ip="", end_ip="", netmask="", leases={}
+    ):
+        self.id = id
+        self.name = name
+        self.labels = labels
+        self.start_ip = start_ip
+        self.end_ip = end_ip
+        self.netmask = netmask
+        self.leases = leases
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["id"],
+            data.get("name", ""),
+            intern_labels(data.get("labels", {})),
+            data.get("start-ip", ""),
+            data.get("end-ip", ""),
+            data.get("netmask", ""),
+            {l["ip"]: l.get("instance-id", "") for l in data.get("leases", [])},
+        )
+
+    def label(self, key, default=""):
+        return self.labels.get(key, default)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "labels": self.labels,
+            "start-ip": self.start_ip,
+            "end-ip": self.end_ip,
+            "netmask": self.netmask,
+            "leases": self.leases,
+        }
+
+
+class Template:
+    __slots__ = ("id", "name", "family", "default_user", "size")
+
+    def __init__(self, id, name, family="", default_user="", size=0):
+        self.id = id
+        self.name = name
+        self.family = family
+        self.default_user = default_user
+        self.size = size
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["id"],
+            data.get("name", ""),
+            sys.intern(data.get("family", "")),
+            data.get("default-user", ""),
+            data.get("size", 0),
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "family": self.family,
+            "default-user": self.default_user,
+            "size": self.size,
+        }
+
+
+class DnsRecord:
+    __slots__ = ("id", "name", "type", "content", "system")
+
+    def __init__(self, id, name, type="A", content="", system=False):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.content = content
+        self.system = system
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["id"],
+            data.get("name", ""),
+            sys.intern(data.get("type", "")),
+            data.get("content", ""),
+            data.get("system-record", True),
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "type": self.type,
+            "content": self.content,
+            "system-record": self.system,
+        }
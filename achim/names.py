@@ -0,0 +1,82 @@
+import json
+import os
+
+from achim.utils import cache_dir
+
+
+class NameCache:
+    def __init__(self, path=None):
+        self.path = path
+        self.updates = {}
+
+    def remember_instances(self, instances):
+        labels = {}
+        for instance in instances:
+            for key, value in instance.labels.items():
+                labels.setdefault(key, set()).add(value)
+        self.updates["instances"] = sorted({i.name for i in instances})
+        self.updates["labels"] = {k: sorted(v) for k, v in labels.items()}
+        self.updates["scenarios"] = sorted(labels.get("scenario", []))
+
+    def remember_networks(self, networks):
+        self.updates["networks"] = sorted({n.name for n in networks})
+
+    def remember_images(self, templates):
+        self.updates["images"] = sorted({t.name for t in templates})
+
+    def save(self):
+        if not self.updates:
+            return
+        try:
+            path = self.path or names_path()
+            names = {**load_names(path), **self.updates}
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(names, f)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            pass
+
+
+def names_path():
+    return os.path.join(cache_dir(), "names.json")
+
+
+def load_names(path=None):
+    try:
+        with open(path or names_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def completer(kind):
+    def complete(ctx, param, incomplete):
+        names = load_names().get(kind, [])
+        return [n for n in names if n.lower().startswith(incomplete.lower())]
+
+    return complete
+
+
+def label_completer(key):
+    def complete(ctx, param, incomplete):
+        values = load_names().get("labels", {}).get(key, [])
+        return [v for v in values if v.startswith(incomplete)]
+
+    return complete
+
+
+def choice_completer(choices):
+    def complete(ctx, param, incomplete):
+        return [c for c in choices if c.startswith(incomplete)]
+
+    return complete
+
+
+def complete_selector(ctx, param, incomplete):
+    labels = load_names().get("labels", {})
+    done, _, current = incomplete.rpartition(",")
+    prefix = f"{done}," if done else ""
+    if "=" not in current:
+        return [f"{prefix}{k}=" for k in sorted(labels) if k.startswith(current)]
+    key, _, value = current.partition("=")
+    return [f"{prefix}{key}={v}" for v in labels.get(key, []) if v.startswith(value)]
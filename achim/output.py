@@ -0,0 +1,55 @@
+import csv
+import json
+import sys
+import threading
+
+formats = ["table", "jsonl", "csv"]
+
+
+class Output:
+    def __init__(self, format="table", file=None):
+        if format not in formats:
+            raise ValueError(f"unknown output format '{format}', use one of {formats}")
+        self.format = format
+        self.file = file
+        self.fields = None
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        file = self.file or sys.stdout
+        if hasattr(record, "to_dict"):
+            record = record.to_dict()
+        with self.lock:
+            if self.format == "jsonl":
+                file.write(json.dumps(record, default=str) + "\n")
+            else:
+                self.write_row(file, record)
+            file.flush()
+
+    def write_row(self, file, record):
+        fields = list(record.keys())
+        rows = []
+        if self.format == "csv" and self.fields is not None:
+            extra = [f for f in fields if f not in self.fields]
+            if extra:
+                raise ValueError(
+                    f"csv output cannot add columns {extra} to {self.fields}, "
+                    "use jsonl instead"
+                )
+            fields = self.fields
+        if fields != self.fields:
+            self.fields = fields
+            rows.append(fields)
+        rows.append([format_value(record.get(f, "")) for f in fields])
+        if self.format == "csv":
+            csv.writer(file).writerows(rows)
+        else:
+            file.writelines("\t".join(row) + "\n" for row in rows)
+
+
+def format_value(value):
+    if isinstance(value, dict):
+        return ",".join(f"{k}={format_value(v)}" for k, v in value.items())
+    if isinstance(value, list):
+        return ",".join(format_value(v) for v in value)
+    return str(value)
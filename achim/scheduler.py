@@ -0,0 +1,72 @@
+import math
+
+resources = ["instance", "private-network"]
+
+
+def free_capacity(quotas):
+    by_resource = {q["resource"]: q for q in quotas}
+    free = {}
+    for resource in resources:
+        quota = by_resource.get(resource, {})
+        limit = quota.get("limit", -1)
+        free[resource] = math.inf if limit < 0 else limit - quota.get("usage", 0)
+    return free
+
+
+def shared_capacity(quotas_by_zone):
+    if len(quotas_by_zone) < 2:
+        return {}
+    raw = [
+        {q["resource"]: (q.get("limit"), q.get("usage")) for q in quotas}
+        for quotas in quotas_by_zone.values()
+    ]
+    first = next(iter(quotas_by_zone.values()))
+    return {
+        resource: free_capacity(first)[resource]
+        for resource in resources
+        if resource in raw[0] and all(r.get(resource) == raw[0][resource] for r in raw)
+    }
+
+
+def place_scenario(users, scenario, quotas_by_zone):
+    needs = {
+        "instance": len(scenario["instances"]),
+        "private-network": len(scenario.get("networks", [])),
+    }
+    capacities = {z: free_capacity(q) for z, q in quotas_by_zone.items()}
+    return place_users(users, needs, capacities, shared_capacity(quotas_by_zone))
+
+
+def place_users(users, needs, capacities, shared={}):
+    remaining = {zone: dict(free) for zone, free in capacities.items()}
+    remaining_shared = dict(shared)
+    placement = {zone: [] for zone in capacities}
+
+    def free(zone, resource):
+        if resource in remaining_shared:
+            return remaining_shared[resource]
+        return remaining[zone][resource]
+
+    def headroom(zone):
+        return min(free(zone, r) - n for r, n in needs.items())
+
+    for user in users:
+        fitting = [zone for zone in remaining if headroom(zone) >= 0]
+        if not fitting:
+            total = {r: n * len(users) for r, n in needs.items()}
+            available = {
+                r: shared[r] if r in shared else sum(c[r] for c in capacities.values())
+                for r in needs
+            }
+            raise ValueError(
+                f"scenario does not fit into the quotas of {', '.join(capacities)}: "
+                f"needs {total}, free {available}"
+            )
+        zone = max(fitting, key=lambda z: (headroom(z), -len(placement[z])))
+        for resource, n in needs.items():
+            if resource in remaining_shared:
+                remaining_shared[resource] -= n
+            else:
+                remaining[zone][resource] -= n
+        placement[zone].append(user)
+    return {zone: users for zone, users in placement.items() if users}
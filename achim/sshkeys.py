@@ -0,0 +1,82 @@
+import base64
+import binascii
+import hashlib
+import json
+import os
+
+from achim.utils import cache_dir, run_concurrently, to_host_name
+
+
+def fingerprint(public_key):
+    parts = public_key.split()
+    if len(parts) < 2:
+        raise ValueError(f"malformed SSH public key '{public_key}'")
+    try:
+        blob = base64.b64decode(parts[1], validate=True)
+    except binascii.Error:
+        raise ValueError(f"malformed SSH public key '{public_key}'")
+    digest = hashlib.md5(blob).hexdigest()
+    return ":".join(digest[i : i + 2] for i in range(0, len(digest), 2))
+
+
+def key_name(user_name, fingerprint):
+    return f"{to_host_name(user_name)}-{fingerprint.replace(':', '')[:8]}"
+
+
+def keys_path(api_key):
+    account = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir(), f"ssh-keys-{account}.json")
+
+
+def load_keys(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_keys(path, keys):
+    try:
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(keys, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass
+
+
+def register_user_keys(exo, users, path, workers=16):
+    fingerprints = {}
+    problems = []
+    for user in users:
+        if not user.get("ssh_key"):
+            continue
+        try:
+            fingerprints[user["name"]] = fingerprint(user["ssh_key"])
+        except ValueError as e:
+            problems.append(f"user '{user['name']}': {e}")
+    if problems:
+        raise ValueError("; ".join(problems))
+    known = load_keys(path)
+    missing = {fp for fp in fingerprints.values() if fp not in known}
+    if missing:
+        known.update({k["fingerprint"]: k["name"] for k in exo.list_ssh_keys()})
+        keys = {u["name"]: u["ssh_key"] for u in users if u["name"] in fingerprints}
+        unregistered = {}
+        for name, fp in fingerprints.items():
+            if fp not in known:
+                unregistered.setdefault(fp, (key_name(name, fp), keys[name]))
+
+        def register(fp):
+            name, public_key = unregistered[fp]
+            return exo.wait_for_operation(exo.register_ssh_key(name, public_key))
+
+        for fp, result in run_concurrently(register, unregistered, workers):
+            if result.get("state", "") == "success":
+                known[fp] = unregistered[fp][0]
+            else:
+                problems.append(f"registering '{unregistered[fp][0]}' failed")
+        save_keys(path, known)
+    if problems:
+        raise ValueError("; ".join(problems))
+    return {name: known[fp] for name, fp in fingerprints.items()}
@@ -1,19 +1,38 @@
-def increment_ip(ip_str):
-    ip = parse_ipv4(ip_str)
-    ip = [s if i < 3 else s + 1 for i, s in enumerate(ip)]
-    return ".".join([str(s) for s in ip])
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import ipaddress
+import os
+import socket
 
 
-def parse_ipv4(ip_str):
-    segments = ip_str.strip().split(".")
-    segments = [int(s) for s in segments]
-    return segments
+def increment_ip(ip_str):
+    return str(ipaddress.IPv4Address(ip_str.strip()) + 1)
 
 
 def is_valid_ipv4(ip_str):
-    segments = parse_ipv4(ip_str)
-    segments = [s for s in segments if s >= 0 and s <= 255]
-    return len(segments) == 4
+    try:
+        ipaddress.IPv4Address(ip_str.strip())
+    except ValueError:
+        return False
+    return True
+
+
+def to_host_name(name):
+    return name.replace(".", "-").replace("_", "-")
+
+
+def cache_dir(*parts):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    path = os.path.join(base, "achim", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def is_port_open(ip, port, timeout=3):
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
 
 
 def parse_label_value_arg(arg):
@@ -26,3 +45,27 @@ def parse_label_value_arg(arg):
         for x in label_values
         if len(x) == 2 and x[0] and x[1]
     }
+
+
+def parse_list_arg(arg):
+    return [item.strip() for item in arg.split(",") if item.strip()]
+
+
+def change_labels(labels, add={}, remove=[], rename={}):
+    changed = dict(labels)
+    for old, new in rename.items():
+        if old in changed:
+            changed[new] = changed.pop(old)
+    for key in remove:
+        changed.pop(key, None)
+    return changed | add
+
+
+def run_concurrently(fn, items, workers=16, executor=None):
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from run_concurrently(fn, items, executor=executor)
+        return
+    futures = {executor.submit(fn, item): item for item in items}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
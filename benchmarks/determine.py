@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from achim.achim import (
+    determine_attachments,
+    determine_instances,
+    determine_networks,
+)
+from achim.models import Instance, Network
+
+scenario_path = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "examples",
+    "ipfire-firewall-with-ubuntu-windows.yaml",
+)
+
+
+class FakeExoscale:
+    def __init__(self, networks, instances):
+        self.networks = networks
+        self.instances = instances
+
+    def get_networks(self):
+        return self.networks
+
+    def get_instances(self):
+        return self.instances
+
+
+def load_scenario():
+    with open(scenario_path, encoding="utf-8") as f:
+        scenario = yaml.safe_load(f)
+    extra = [{"name": f"extra{i}", "image": "x", "size": "micro"} for i in range(2)]
+    scenario["instances"] += extra
+    return scenario
+
+
+def plan(scenario, users):
+    instances_by_username = determine_instances(scenario["instances"], users)
+    networks_by_username = determine_networks(
+        scenario["networks"], users, instances_by_username
+    )
+    networks = [n for ns in networks_by_username.values() for n in ns]
+    instances = [i for ins in instances_by_username.values() for i in ins]
+    exo = FakeExoscale(
+        [Network(f"n{k}", n["canonical_name"]) for k, n in enumerate(networks)],
+        [Instance(f"i{k}", i["canonical_name"]) for k, i in enumerate(instances)],
+    )
+    return determine_attachments(exo, networks_by_username)
+
+
+def main(counts=(10, 100, 1000), repeat=5):
+    scenario = load_scenario()
+    print(f"{'users':>6} {'ms':>9} {'us/user':>8}")
+    for count in counts:
+        users = [{"name": f"user_{k}.x"} for k in range(count)]
+        best = min(timed(plan, scenario, users) for _ in range(repeat))
+        print(f"{count:>6} {best * 1000:>9.1f} {best * 1e6 / count:>8.1f}")
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()